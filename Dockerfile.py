@@ -15,6 +15,8 @@ RUN apk --no-cache add \
 
 # Expose any ports the app is expecting in the environment
 ENV PORT 5000
+ENV SERVER_MODE production
+ENV WEB_WORKERS 2
 EXPOSE $PORT
 
 # Set up a working folder and install the pre-reqs
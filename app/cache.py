@@ -0,0 +1,159 @@
+"""
+Order Cache
+
+A bounded in-process LRU cache with a time to live, used in front of
+Order.find. Entries are invalidated locally when an Order is written
+and in every other worker through a Redis pub/sub channel that the
+writer publishes the Order's id on ('*' clears everything, and also
+tells the listener's owner that the Orders were reset). With sharding
+the channel is listened to on every node.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from redis.exceptions import ConnectionError, TimeoutError
+
+logger = logging.getLogger(__name__)
+
+CLEAR_ALL = '*'
+
+######################################################################
+# LRU Cache with a time to live
+######################################################################
+class LRUCache(object):
+    """ A thread-safe LRU cache whose entries expire after ttl seconds """
+
+    def __init__(self, maxsize=0, ttl=5):
+        self.maxsize = maxsize  # 0 disables the cache
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        """ True when the cache holds anything at all """
+        return self.maxsize > 0
+
+    def get(self, key):
+        """ Returns the cached value or None """
+        if not self.enabled:
+            return None
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.__entries[key] = entry     # most recently used goes last
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """ Caches a value, evicting the least recently used one if full """
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.time() + self.ttl, value)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """ Drops one entry """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """ Drops every entry """
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counters """
+        with self.__lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self.__entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def listen(self, clients, channel, on_clear_all=None):
+        """
+        Starts the threads applying invalidations published on every client
+
+        on_clear_all, if given, is called whenever everything is cleared
+        by a message.
+        """
+        if not self.enabled:
+            return
+        listeners = self.__listeners
+        if len(listeners) == len(clients) and all(
+                listener.is_alive() and listener.pid == os.getpid() and listener.redis is redis
+                for listener, redis in zip(listeners, clients)):
+            return
+        for listener in listeners:
+            listener.stop()
+        self.__listeners = [InvalidationListener(self, redis, channel, on_clear_all)
+                            for redis in clients]
+        for listener in self.__listeners:
+            listener.start()
+
+######################################################################
+# Invalidation listener
+######################################################################
+class InvalidationListener(threading.Thread):
+    """ Applies the invalidations published on a channel to a cache """
+
+    def __init__(self, cache, redis, channel, on_clear_all=None):
+        super(InvalidationListener, self).__init__(name='order-cache-invalidation')
+        self.daemon = True
+        self.cache = cache
+        self.redis = redis
+        self.channel = channel
+        self.on_clear_all = on_clear_all
+        self.pid = os.getpid()
+        self.__stopped = threading.Event()
+
+    def stop(self):
+        """ Asks the thread to stop after its current wait """
+        self.__stopped.set()
+
+    def run(self):
+        """ Subscribes and applies messages, resubscribing after errors """
+        delay = 0.1
+        while not self.__stopped.is_set():
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                # messages may have been missed while we were not subscribed
+                self.cache.clear()
+                delay = 0.1
+                while not self.__stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message:
+                        self.apply(message['data'])
+            except (ConnectionError, TimeoutError) as error:
+                logger.warning('Cache invalidation listener lost Redis (%s)', error)
+                self.__stopped.wait(delay)
+                delay = min(delay * 2, 5)
+            finally:
+                pubsub.close()
+
+    def apply(self, data):
+        """ Applies one invalidation message """
+        if data == CLEAR_ALL:
+            self.cache.clear()
+            if self.on_clear_all is not None:
+                self.on_clear_all()
+        else:
+            self.cache.invalidate(int(data))
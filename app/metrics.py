@@ -0,0 +1,119 @@
+"""
+Metrics
+
+Records Prometheus metrics and serves them on GET /metrics:
+
+orders_http_request_duration_seconds{method,route,status} - request latency
+orders_redis_command_duration_seconds{command} - Redis command latency
+orders_list_results{query} - Orders returned per GET /orders
+orders_redis_pool_* / orders_cache_* - pool and cache usage, read when scraped
+
+Histogram _count series are the request and command counts. Under a
+pre-forked server set PROMETHEUS_MULTIPROC_DIR to an empty directory so
+the histograms of every worker are added up; the pool and cache figures
+are then those of the worker answering the scrape.
+"""
+
+import os
+import time
+from flask import request, g, make_response
+from prometheus_client import (Histogram, CollectorRegistry, generate_latest,
+                               CONTENT_TYPE_LATEST, REGISTRY)
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from app.server import app
+from app.models import Order
+from app import redis_pool
+
+REQUEST_LATENCY = Histogram(
+    'orders_http_request_duration_seconds', 'Latency of HTTP requests',
+    ['method', 'route', 'status'])
+
+REDIS_LATENCY = Histogram(
+    'orders_redis_command_duration_seconds', 'Latency of Redis commands and pipelines',
+    ['command'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+LIST_RESULTS = Histogram(
+    'orders_list_results', 'Orders returned by one GET /orders',
+    ['query'], buckets=(0, 1, 10, 100, 1000, 10000, 100000))
+
+######################################################################
+# Pool and cache usage, read when scraped
+######################################################################
+class UsageCollector(object):
+    """ Reports the connection pool and cache counters of this process """
+
+    def collect(self):
+        pool = Order.pool_stats()
+        if pool:
+            connections = GaugeMetricFamily('orders_redis_pool_connections',
+                                            'Redis connections of the pools', labels=['state'])
+            for state in ['in_use', 'peak_in_use', 'created', 'max_connections']:
+                connections.add_metric([state], pool[state])
+            yield connections
+            yield CounterMetricFamily('orders_redis_pool_checkouts',
+                                      'Connections checked out of the pools', pool['checkouts'])
+            yield CounterMetricFamily('orders_redis_pool_wait_seconds',
+                                      'Time spent waiting for a free connection',
+                                      pool['wait_seconds'])
+        cache = Order.cache.stats()
+        lookups = CounterMetricFamily('orders_cache_lookups', 'Order cache lookups',
+                                      labels=['result'])
+        lookups.add_metric(['hit'], cache['hits'])
+        lookups.add_metric(['miss'], cache['misses'])
+        yield lookups
+        yield CounterMetricFamily('orders_cache_evictions', 'Order cache evictions',
+                                  cache['evictions'])
+        yield GaugeMetricFamily('orders_cache_size', 'Orders in the cache', cache['size'])
+
+USAGE = UsageCollector()
+REGISTRY.register(USAGE)
+
+def registry():
+    """ Returns the registry to expose, adding up every worker in multiprocess mode """
+    if not (os.environ.get('PROMETHEUS_MULTIPROC_DIR') or
+            os.environ.get('prometheus_multiproc_dir')):
+        return REGISTRY
+    from prometheus_client import multiprocess
+    combined = CollectorRegistry()
+    multiprocess.MultiProcessCollector(combined)
+    combined.register(USAGE)
+    return combined
+
+def observe_list(query, count):
+    """ Records how many Orders a GET /orders returned """
+    LIST_RESULTS.labels(query).observe(count)
+
+######################################################################
+# Request hooks
+######################################################################
+redis_pool.OBSERVERS.append(lambda command, seconds: REDIS_LATENCY.labels(command).observe(seconds))
+
+@app.before_request
+def start_timer():
+    """ Notes when the request started """
+    g.metrics_start = time.time()
+
+@app.after_request
+def record_request(response):
+    """ Records the latency of a request that produced a response """
+    observe_request(response.status_code)
+    return response
+
+@app.teardown_request
+def record_failure(error=None):
+    """ Records a request that failed with an unhandled exception """
+    if error is not None:
+        observe_request(500)
+
+def observe_request(status_code):
+    """ Records the latency of the current request once """
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_LATENCY.labels(request.method, route, str(status_code)).observe(time.time() - start)
+
+@app.route('/metrics')
+def metrics():
+    """ Returns the metrics in the Prometheus text format """
+    return make_response(generate_latest(registry()), 200, {'Content-Type': CONTENT_TYPE_LATEST})
@@ -25,13 +25,310 @@ for a server name 'redis' to connect to.
 """
 
 import os
+import re
 import json
+import time
+import math
+import calendar
 import logging
 import pickle
-from cerberus import Validator
-from redis import Redis
+import threading
+from collections import namedtuple
+from datetime import datetime
 from redis.exceptions import ConnectionError
 from app.custom_exceptions import DataValidationError
+from app import redis_pool
+from app.cache import LRUCache, CLEAR_ALL
+from app.sharding import HashRing
+from app.validation import CompiledValidator
+from app.timing import Phase
+
+######################################################################
+# Record Codecs
+#   Every stored Order starts with a version byte naming the codec
+#   that wrote it. Records written before codecs existed are bare
+#   pickles and get rewritten with the current codec when read.
+#   PURCHASE_SCRIPT and PATCH_SCRIPT edit JsonCodec records in place,
+#   so purchase() and patch() only work while it is Order.codec.
+######################################################################
+class JsonCodec(object):
+    """ Compact JSON with sorted keys, readable from any language """
+
+    version = '\x01'
+
+    @staticmethod
+    def encode(data):
+        """ Encodes a dictionary into a record """
+        return JsonCodec.version + json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+    @staticmethod
+    def decode(record):
+        """ Decodes a record into a dictionary """
+        return json.loads(record[1:])
+
+
+class PickleCodec(object):
+    """ The legacy pickle records, which carry no version byte """
+
+    version = None
+
+    @staticmethod
+    def encode(data):
+        """ Encodes a dictionary into a record """
+        return pickle.dumps(data)
+
+    @staticmethod
+    def decode(record):
+        """ Decodes a record into a dictionary """
+        return pickle.loads(record)
+
+# Codecs that can be read, by version byte
+CODECS = dict((codec.version, codec) for codec in [JsonCodec])
+
+# An Order as the JSON body serialize() gives, compact with sorted keys
+OrderJson = namedtuple('OrderJson', ['id', 'json'])
+
+# ISO 8601 times indexed by timestamp: 2017-09-15, 2017-09-15T10:30 or
+# 2017-09-15 10:30:00.250+02:00 (UTC unless an offset is given)
+TIME_FORMAT = re.compile(r'^(\d{4})-(\d{2})-(\d{2})'
+                         r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(\.\d+)?)?)?'
+                         r'(Z|[+-]\d{2}:?\d{2})?$', re.IGNORECASE)
+
+# Seconds from 0001-01-01 to the epoch, so no timeline position is negative
+TIMELINE_OFFSET = 62135596800
+
+# Replaces a legacy record only if nobody has rewritten it since it was read
+UPGRADE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Outcomes of Order.purchase()
+PURCHASED = 'purchased'
+NOT_FOUND = 'not found'
+NOT_AVAILABLE = 'not available'
+
+# Purchases an Order in a single step: flips the status of its record and
+# moves the index entries, counts, revision and generation along with it.
+# KEYS: order, status true index, status false index, counts, revision,
+# modified, generation; ARGV: id, time, invalidation channel ('' for none).
+# A current record is compact JSON whose strings escape every quote, so
+# "status":true or "status":false can only be the status field itself.
+PURCHASE_SCRIPT = """
+local record = redis.call('GET', KEYS[1])
+if not record then
+    return {0}
+end
+if string.sub(record, 1, 1) ~= '\\1' then
+    return {3}
+end
+local body = string.sub(record, 2)
+local first, last = string.find(body, '"status":true', 1, true)
+if not first then
+    return {2}
+end
+body = string.sub(body, 1, first - 1) .. '"status":false' .. string.sub(body, last + 1)
+redis.call('SET', KEYS[1], '\\1' .. body)
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[1], ARGV[1])
+redis.call('HINCRBY', KEYS[4], 'true', -1)
+redis.call('HINCRBY', KEYS[4], 'false', 1)
+local revision = redis.call('HINCRBY', KEYS[5], ARGV[1], 1)
+redis.call('HSET', KEYS[6], ARGV[1], ARGV[2])
+redis.call('HINCRBY', KEYS[7], 'count', 1)
+redis.call('HSET', KEYS[7], 'modified', ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('PUBLISH', ARGV[3], ARGV[1])
+end
+return {1, body, revision}
+"""
+
+# Stores new Orders unless their id is already taken (leased before the id
+# counter was reset), with their index entries, counts, revision and the
+# generation. KEYS: revision, modified, generation, counts, customers;
+# ARGV: time, then for each Order its id, key, record, status index value
+# and name, the number of its index entries and the key, member and score
+# of each. Answers the ids that were taken and left alone.
+CREATE_SCRIPT = """
+local taken = {}
+local written = 0
+local i = 2
+while i <= #ARGV do
+    local id, key = ARGV[i], ARGV[i + 1]
+    local entries = i + 6
+    i = entries + 3 * tonumber(ARGV[i + 5])
+    if redis.call('EXISTS', key) == 1 then
+        table.insert(taken, id)
+    else
+        redis.call('SET', key, ARGV[entries - 4])
+        for j = entries, i - 1, 3 do
+            redis.call('ZADD', ARGV[j], ARGV[j + 2], ARGV[j + 1])
+        end
+        redis.call('HINCRBY', KEYS[4], ARGV[entries - 3], 1)
+        redis.call('ZINCRBY', KEYS[5], 1, ARGV[entries - 2])
+        redis.call('HINCRBY', KEYS[1], id, 1)
+        redis.call('HSET', KEYS[2], id, ARGV[1])
+        written = written + 1
+    end
+end
+if written > 0 then
+    redis.call('HINCRBY', KEYS[3], 'count', 1)
+    redis.call('HSET', KEYS[3], 'modified', ARGV[1])
+end
+return taken
+"""
+
+# Changes some fields of an Order in place: splices their new JSON values
+# into the record and moves the index entries, counts, revision and
+# generation of the fields that changed. KEYS: order, revision, modified,
+# generation, counts, customers, timestamps, timeline; ARGV: id, time,
+# invalidation channel ('' for none), key prefix of the index sets, new
+# timestamp and timeline member ('' if the time does not parse), then
+# field, JSON value and index value of each field to change. The old
+# timeline member is rebuilt from the old timestamp as
+# Order.__timeline_member() builds it. The index sets are named after
+# their values, so their keys are built from the prefix (every key lives
+# on the Order's node).
+PATCH_SCRIPT = r"""
+local record = redis.call('GET', KEYS[1])
+if not record then
+    return {0}
+end
+if string.sub(record, 1, 1) ~= '\1' then
+    return {3}
+end
+local body = string.sub(record, 2)
+local values = {}
+local fields = {}
+local position = 2
+while position < #body do
+    local key_end = string.find(body, '"', position + 1, true)
+    local field = string.sub(body, position + 1, key_end - 1)
+    local start = key_end + 2
+    local finish
+    if string.sub(body, start, start) == '"' then
+        finish = start + 1
+        while true do
+            finish = string.find(body, '[\\"]', finish)
+            if string.sub(body, finish, finish) == '"' then
+                break
+            end
+            finish = finish + 2
+        end
+    else
+        finish = string.find(body, '[,}]', start) - 1
+    end
+    values[field] = string.sub(body, start, finish)
+    table.insert(fields, field)
+    position = finish + 2
+end
+local function index_value(value)
+    if type(value) == 'boolean' then
+        return tostring(value)
+    end
+    return string.lower(value)
+end
+local id = ARGV[1]
+local function timeline_member(timestamp)
+    local position = math.max(0, math.floor((timestamp + 62135596800) * 1000000))
+    return string.format('%020d:%020d', position, tonumber(id))
+end
+for i = 7, #ARGV, 3 do
+    local field, value, index = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    local old = values[field]
+    if old ~= value then
+        local old_value = cjson.decode(old)
+        local old_index = index_value(old_value)
+        redis.call('ZREM', ARGV[4] .. field .. ':' .. old_index, id)
+        redis.call('ZADD', ARGV[4] .. field .. ':' .. index, id, id)
+        if field == 'status' then
+            redis.call('HINCRBY', KEYS[5], old_index, -1)
+            redis.call('HINCRBY', KEYS[5], index, 1)
+        elseif field == 'name' then
+            redis.call('ZINCRBY', KEYS[6], -1, old_value)
+            redis.call('ZREMRANGEBYSCORE', KEYS[6], '-inf', 0)
+            redis.call('ZINCRBY', KEYS[6], 1, cjson.decode(value))
+        elseif field == 'time' then
+            local old_timestamp = redis.call('ZSCORE', KEYS[7], id)
+            if old_timestamp then
+                redis.call('ZREM', KEYS[8], timeline_member(tonumber(old_timestamp)))
+            end
+            redis.call('ZREM', KEYS[7], id)
+            if ARGV[5] ~= '' then
+                redis.call('ZADD', KEYS[7], ARGV[5], id)
+                redis.call('ZADD', KEYS[8], 0, ARGV[6])
+            end
+        end
+        values[field] = value
+    end
+end
+table.sort(fields)
+local parts = {}
+for _, field in ipairs(fields) do
+    table.insert(parts, '"' .. field .. '":' .. values[field])
+end
+body = '{' .. table.concat(parts, ',') .. '}'
+redis.call('SET', KEYS[1], '\1' .. body)
+local revision = redis.call('HINCRBY', KEYS[2], id, 1)
+redis.call('HSET', KEYS[3], id, ARGV[2])
+redis.call('HINCRBY', KEYS[4], 'count', 1)
+redis.call('HSET', KEYS[4], 'modified', ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('PUBLISH', ARGV[3], id)
+end
+return {1, body, revision}
+"""
+
+######################################################################
+# Id Allocation
+######################################################################
+class IdAllocator(object):
+    """
+    Hands out Order ids from blocks leased from a Redis counter
+
+    Each process leases block_size ids at a time with one INCRBY and
+    then hands them out locally, so most new Orders need no round trip
+    for their id. Ids left in a block when the process exits are never
+    used (gaps are fine), and a forked child drops the block it
+    inherited so two processes never hand out the same id. Resetting
+    the counter makes every other process's block stale: they drop it
+    when the reset is announced (see release()), and Order never writes
+    a new id over an existing Order in case the announcement is missed.
+    """
+
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Drops the current block so the next id comes from Redis """
+        self.__pid = os.getpid()
+        self.__next = 1
+        self.__last = 0
+
+    def release(self):
+        """ Drops the current block from another thread, e.g. after the counter was reset """
+        with self.__lock:
+            self.reset()
+
+    def allocate(self, redis, key, count=1):
+        """ Reserves count consecutive ids and returns the first one """
+        with self.__lock:
+            if self.__pid != os.getpid():
+                self.reset()
+            if self.__next + count - 1 > self.__last:
+                if count >= self.block_size:
+                    last = redis.incrby(key, count)
+                    return last - count + 1
+                self.__last = redis.incrby(key, self.block_size)
+                self.__next = self.__last - self.block_size + 1
+            first = self.__next
+            self.__next += count
+            return first
 
 ######################################################################
 # Order Model for database
@@ -42,14 +339,26 @@ class Order(object):
     """ Order interface to database """
 
     logger = logging.getLogger(__name__)
-    redis = None
+    redis = None        # the primary node, holds the id counter
+    redis_settings = {} # connection pool settings, see redis_pool.DEFAULTS
+    shard_urls = []     # redis:// urls of the nodes sharing the Orders with the primary
+    replica_urls = []   # redis:// urls of the primary's read replicas
+    ring = None         # routes each Order to its node, see sharding.HashRing
+    __reads = threading.local() # whether this thread reads from the primaries
+    batch_size = 500    # keys per SCAN page and MGET
+    codec = JsonCodec   # codec used to write records
+    allocator = IdAllocator()
+    cache = LRUCache()  # disabled until configured with a size
+    namespace = 'orders'    # prefix of every key, see key()
     schema = {
         'id': {'type': 'integer'},
         'name': {'type': 'string', 'required': True},
         'time': {'type': 'string', 'required': True},
         'status': {'type': 'boolean', 'required': True}
         }
-    __validator = Validator(schema)
+    indexes = ('name', 'time', 'status')
+    __validator = CompiledValidator(schema)  # stateless, shared by every thread
+    __scripts = {}      # Lua scripts by source, loaded into each node on first use
 
     def __init__(self, id=0, name=None, time=None, status=True):
         """ Constructor """
@@ -57,18 +366,171 @@ class Order(object):
         self.name = name
         self.time = time
         self.status = status
+        self.revision = 0       # bumped on every write, set by find()
+        self.modified = None    # epoch seconds of the last write, set by find()
 
     def save(self):
         """ Saves a Order in the database """
         if self.name is None:   # name is the only required field
             raise DataValidationError('name attribute is not set')
         if self.id == 0:
-            self.id = Order.__next_index()
-        Order.redis.set(self.id, pickle.dumps(self.serialize()))
+            Order.read_from_primary()
+            while True:
+                self.id = Order.__next_index()
+                if not Order.__create(Order.__node(self.id), [self]):
+                    break
+                # an id of a block leased before the counter was reset
+                Order.allocator.release()
+        else:
+            Order.read_from_primary()
+            Order.__node(self.id).transaction(self.__write, Order.key('order', self.id))
+            Order.cache.invalidate(self.id)
 
     def delete(self):
         """ Deletes a Order from the database """
-        Order.redis.delete(self.id)
+        Order.read_from_primary()
+        Order.__node(self.id).transaction(self.__erase, Order.key('order', self.id))
+        Order.cache.invalidate(self.id)
+
+    @staticmethod
+    def purchase(order_id):
+        """
+        Purchases an Order atomically in one round trip
+
+        Returns (PURCHASED, body) with the JSON body of the purchased
+        Order (see find_json()), or (NOT_FOUND, None) or (NOT_AVAILABLE,
+        None) when there is no such Order or it was already purchased.
+        """
+        order_id = int(order_id)
+        keys = [Order.key('order', order_id), Order.__index_key('status', True),
+                Order.__index_key('status', False), Order.key('counts'),
+                Order.key('revision'), Order.key('modified'), Order.key('generation')]
+        result = Order.__rewrite(PURCHASE_SCRIPT, order_id, keys, [])
+        if result[0] == 1:
+            return PURCHASED, result[1]
+        if result[0] == 2:
+            return NOT_AVAILABLE, None
+        return NOT_FOUND, None
+
+    @staticmethod
+    def patch(order_id, data):
+        """
+        Changes some fields of an Order in place, in one round trip
+
+        Only the fields in data are validated and written; an id in it is
+        ignored, as save() keeps the Order's own. Returns the JSON body of
+        the updated Order (see find_json()), or None if there is no such Order.
+        """
+        with Phase('validate'):
+            problem = Order.__problem(data, update=True)
+        if problem:
+            raise DataValidationError(problem)
+        fields = sorted(field for field in data if field != 'id')
+        if not fields:
+            raise DataValidationError('Invalid order data: no field to update')
+        order_id = int(order_id)
+        timestamp = Order.parse_time(data['time']) if 'time' in data else None
+        args = [Order.key('')]
+        if timestamp is None:
+            args.extend(['', ''])
+        else:
+            args.extend([repr(timestamp), Order.__timeline_member(timestamp, order_id)])
+        for field in fields:
+            args.extend([field, json.dumps(data[field]), Order.__index_value(data[field])])
+        keys = [Order.key('order', order_id), Order.key('revision'), Order.key('modified'),
+                Order.key('generation'), Order.key('counts'), Order.key('customers'),
+                Order.key('timestamps'), Order.key('timeline')]
+        result = Order.__rewrite(PATCH_SCRIPT, order_id, keys, args)
+        return result[1] if result[0] == 1 else None
+
+    @staticmethod
+    def __rewrite(script, order_id, keys, args):
+        """
+        Runs a script that rewrites a stored Order on its node
+
+        The script gets the id, the time and the invalidation channel
+        ahead of args, and answers 3 for a legacy record it cannot read,
+        which is then upgraded by reading it and the script run again.
+        A record still unreadable after that was written by a codec other
+        than JsonCodec, which the scripts cannot edit, and raises RuntimeError.
+        """
+        Order.read_from_primary()
+        node = Order.__node(order_id)
+        channel = Order.key('invalidate') if Order.cache.enabled else ''
+        args = [order_id, repr(time.time()), channel] + args
+        result = Order.__run(script, node, keys, args)
+        if result[0] == 3:
+            Order.find(order_id)
+            result = Order.__run(script, node, keys, args)
+            if result[0] == 3:
+                raise RuntimeError('Order {} is not stored as JsonCodec records, which '
+                                   'the scripts need'.format(order_id))
+        Order.cache.invalidate(order_id)
+        return result
+
+    @staticmethod
+    def __run(script, node, keys, args):
+        """ Runs a Lua script on a node by its SHA, loading it there the first time """
+        if script not in Order.__scripts:
+            Order.__scripts[script] = node.register_script(script)
+        return Order.__scripts[script](keys, args, client=node)
+
+    @staticmethod
+    def __create(node, orders):
+        """ Stores new Orders on their node in one round trip, returns the ids already taken """
+        args = [repr(time.time())]
+        for order in orders:
+            data = order.serialize()
+            entries = Order.__entries(data)
+            args.extend([order.id, Order.key('order', order.id), Order.codec.encode(data),
+                         Order.__index_value(data['status']), data['name'], len(entries)])
+            for entry in entries:
+                args.extend(entry)
+        keys = [Order.key('revision'), Order.key('modified'), Order.key('generation'),
+                Order.key('counts'), Order.key('customers')]
+        return [int(order_id) for order_id in Order.__run(CREATE_SCRIPT, node, keys, args)]
+
+    def __write(self, pipe):
+        """ Replaces the stored Order and moves its index entries """
+        old = pipe.get(Order.key('order', self.id))
+        pipe.multi()
+        if old is not None:
+            Order.__unindex(pipe, Order.__decode(old))
+        Order.__put(pipe, self.serialize())
+        Order.__touch(pipe)
+        Order.__publish(pipe, self.id)
+
+    @staticmethod
+    def __put(pipe, data):
+        """ Queues the writes that store an Order, index it and bump its revision """
+        pipe.set(Order.key('order', data['id']), Order.codec.encode(data))
+        Order.__index(pipe, data)
+        pipe.hincrby(Order.key('revision'), data['id'], 1)
+        pipe.hset(Order.key('modified'), data['id'], repr(time.time()))
+
+    @staticmethod
+    def __touch(pipe):
+        """ Queues the bump of the collection generation after a write """
+        pipe.hincrby(Order.key('generation'), 'count', 1)
+        pipe.hset(Order.key('generation'), 'modified', repr(time.time()))
+
+    @staticmethod
+    def __publish(pipe, order_id):
+        """ Queues the message that drops an Order from every worker's cache """
+        if Order.cache.enabled:
+            pipe.publish(Order.key('invalidate'), order_id)
+
+    def __erase(self, pipe):
+        """ Removes the stored Order together with its index entries """
+        old = pipe.get(Order.key('order', self.id))
+        pipe.multi()
+        if old is not None:
+            Order.__unindex(pipe, Order.__decode(old))
+        pipe.delete(Order.key('order', self.id))
+        pipe.hdel(Order.key('revision'), self.id)
+        pipe.hdel(Order.key('modified'), self.id)
+        Order.__touch(pipe)
+        Order.__publish(pipe, self.id)
 
     def serialize(self):
         """ serializes a Order into a dictionary """
@@ -81,45 +543,522 @@ class Order(object):
 
     def deserialize(self, data):
         """ deserializes a Order my marshalling the data """
-        if isinstance(data, dict) and Order.__validator.validate(data):
-            self.name = data['name']
-            self.time = data['time']
-            self.status = data['status']
-        else:
-            raise DataValidationError('Invalid order data: ' + str(Order.__validator.errors))
+        with Phase('validate'):
+            problem = Order.__problem(data)
+        if problem:
+            raise DataValidationError(problem)
+        self.name = data['name']
+        self.time = data['time']
+        self.status = data['status']
         return self
 
+    @staticmethod
+    def deserialize_all(items):
+        """
+        Deserializes a batch of new Orders
+
+        Returns the Orders of the valid items and a list of (index,
+        message) pairs for the invalid ones, the messages being those
+        deserialize() raises.
+        """
+        orders = []
+        problems = []
+        for index, data in enumerate(items):
+            problem = Order.__problem(data)
+            if problem:
+                problems.append((index, problem))
+            else:
+                orders.append(Order(0, data['name'], data['time'], data['status']))
+        return orders, problems
+
+    @staticmethod
+    def __problem(data, update=False):
+        """ Returns why data is not a valid Order (or update of one), or None if it is """
+        if not isinstance(data, dict):
+            return 'Invalid order data: must be of dict type'
+        errors = Order.__validator.errors(data, update)
+        if errors:
+            return 'Invalid order data: ' + str(errors)
+        return None
+
 
 ######################################################################
 #  S T A T I C   D A T A B S E   M E T H O D S
 ######################################################################
 
+    @staticmethod
+    def __node(order_id):
+        """ Returns the Redis node that stores an Order """
+        return Order.ring.node(int(order_id))
+
+    @staticmethod
+    def read_from_primary(enabled=True):
+        """
+        Sends this thread's reads to the primaries instead of the replicas
+
+        Every write turns it on so the thread reads its own writes even
+        when the replicas lag behind; the server sets it per request.
+        """
+        Order.__reads.primary = enabled
+
+    @staticmethod
+    def __readers():
+        """ Returns a (node, client to read it from) pair for every node """
+        if getattr(Order.__reads, 'primary', False):
+            return [(node, node) for node in Order.ring.clients]
+        return [(node, Order.ring.replica(node)) for node in Order.ring.clients]
+
+    @staticmethod
+    def __reader(node):
+        """ Returns the client to read a node from """
+        if getattr(Order.__reads, 'primary', False):
+            return node
+        return Order.ring.replica(node)
+
     @staticmethod
     def __next_index():
-        """ Increments the index and returns it """
-        return Order.redis.incr('index')
+        """ Returns the next id from the allocator's block """
+        return Order.allocator.allocate(Order.redis, Order.key('index'))
+
+    @staticmethod
+    def create_all(orders):
+        """
+        Saves a list of new Orders in bulk
+
+        The ids are reserved together from the allocator and the Orders
+        are written by one script call per batch and node, with the nodes
+        written in parallel. Orders whose id turns out to be taken (leased
+        before the counter was reset) are written again under new ids.
+        """
+        for order in orders:
+            if order.name is None:
+                raise DataValidationError('name attribute is not set')
+        if not orders:
+            return orders
+        Order.read_from_primary()
+        pending = orders
+        while pending:
+            first = Order.allocator.allocate(Order.redis, Order.key('index'), len(pending))
+            by_id = {}
+            for offset, order in enumerate(pending):
+                order.id = first + offset
+                by_id[order.id] = order
+
+            def write(group):
+                node, ids = group
+                taken = []
+                for start in xrange(0, len(ids), Order.batch_size):
+                    batch = [by_id[order_id] for order_id in ids[start:start + Order.batch_size]]
+                    taken.extend(by_id[order_id] for order_id in Order.__create(node, batch))
+                return taken
+
+            groups = Order.ring.group([order.id for order in pending])
+            pending = [order for taken in Order.ring.map(write, groups) for order in taken]
+            if pending:
+                Order.allocator.release()
+        return orders
 
     # @staticmethod
     # def use_db(redis):
     #     Order.__redis = redis
 
+    @staticmethod
+    def key(*parts):
+        """ Returns the Redis key for parts inside the Order namespace """
+        return ':'.join([Order.namespace] + [str(part) for part in parts])
+
     @staticmethod
     def remove_all():
-        """ Removes all Orders from the database """
-        Order.redis.flushall()
+        """ Removes all Orders (every key in the namespace) from every node """
+        def remove(node):
+            for keys in Order.__scan_keys(node, Order.key('*')):
+                node.delete(*keys)     # one round trip per SCAN page
+
+        Order.read_from_primary()
+        Order.ring.map(remove)
+        Order.allocator.release()
+        Order.cache.clear()
+        if Order.cache.enabled:
+            Order.redis.publish(Order.key('invalidate'), CLEAR_ALL)
 
     @staticmethod
     def all():
         """ Query that returns all Orders """
-        # results = [Order.from_dict(redis.hgetall(key)) for key in redis.keys() if key != 'index']
+        return Order.__all(Order.__from_records)
+
+    @staticmethod
+    def all_json():
+        """ Query that returns the JSON bodies of all Orders, see find_json() """
+        return [order.json for order in Order.__all(Order.__bodies)]
+
+    @staticmethod
+    def __all(convert):
+        """ Returns every stored Order in id order, as convert makes them of records """
+        # SCAN may return a key twice while Redis is resizing, so key them by id
+        results = {}
+        # the readers are picked here as the thread pool does not see this thread's routing
+        for orders in Order.ring.map(lambda nodes: list(Order.__scan(nodes[0], nodes[1], convert)),
+                                     Order.__readers()):
+            results.update((order.id, order) for order in orders)
+        return [results[order_id] for order_id in sorted(results)]
+
+    @staticmethod
+    def iter_all():
+        """ Query that yields all Orders without holding them in memory """
+        for node, reader in Order.__readers():
+            for order in Order.__scan(node, reader):
+                yield order
+
+    @staticmethod
+    def __scan(node, reader=None, convert=None):
+        """
+        Generator over every Order stored on a node, read from reader if given
+
+        Walks the keyspace with SCAN so Redis is never blocked, and
+        fetches each page of keys with a single MGET. Each page of records
+        is turned into Orders by convert (__from_records by default).
+        """
+        reader = reader or node
+        convert = convert or Order.__from_records
+        for keys in Order.__scan_keys(reader):
+            for order in convert(node, reader.mget(keys)):
+                yield order
+
+    @staticmethod
+    def __scan_keys(node, match=None):
+        """ Generator over the non-empty pages of keys matching match (Order keys) on a node """
+        match = match or Order.key('order', '*')
+        cursor = 0
+        while True:
+            cursor, keys = node.scan(cursor, match=match, count=Order.batch_size)
+            if keys:
+                yield keys
+            if cursor == 0:
+                break
+
+    @staticmethod
+    def __load(ids, convert=None):
+        """ Loads the Orders with these ids in id order, one MGET per batch and node """
+        convert = convert or Order.__from_records
+
+        def load(batch):
+            node, reader, ids = batch
+            keys = [Order.key('order', order_id) for order_id in ids]
+            return convert(node, reader.mget(keys))
+
+        batches = []
+        for node, node_ids in Order.ring.group(ids):
+            reader = Order.__reader(node)
+            for start in xrange(0, len(node_ids), Order.batch_size):
+                batches.append((node, reader, node_ids[start:start + Order.batch_size]))
+        groups = Order.ring.map(load, batches)
+        return sorted((order for orders in groups for order in orders), key=lambda order: order.id)
+
+    @staticmethod
+    def __from_records(node, records):
+        """
+        Creates Orders from the records stored on a node
+
+        Records that were deleted since their key was read (None) are
+        skipped, and legacy ones are upgraded to the current codec on the
+        node itself (never on the replica they may have been read from).
+        """
+        with Phase('decode'):
+            decoded = [(record, Order.__decode(record)) for record in records if record is not None]
+        results = []
+        legacy = []
+        for record, data in decoded:
+            if record[:1] != Order.codec.version:
+                legacy.append((data['id'], record, Order.codec.encode(data)))
+            results.append(Order(data['id']).deserialize(data))
+        if legacy:
+            Order.__upgrade(node, legacy)
+        return results
+
+    @staticmethod
+    def __bodies(node, records):
+        """
+        Returns the JSON bodies of the records stored on a node as OrderJsons
+
+        A current record is its version byte followed by the very JSON
+        serialize() gives, so the body is sliced off without decoding it.
+        Legacy records go through __from_records, which upgrades them.
+        """
         results = []
-        for key in Order.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Order.redis.get(key))
-                order = Order(data['id']).deserialize(data)
-                results.append(order)
+        legacy = []
+        for record in records:
+            if record is None:
+                continue
+            if record[:1] == JsonCodec.version:
+                body = record[1:]
+                results.append(OrderJson(Order.__body_id(body), body))
+            else:
+                legacy.append(record)
+        if legacy:
+            results.extend(OrderJson(order.id, Order.__body(order)) for order in
+                           Order.__from_records(node, legacy))
         return results
 
+    @staticmethod
+    def __body(order):
+        """ Returns the JSON body of an Order, as a current record holds it """
+        return JsonCodec.encode(order.serialize())[1:]
+
+    @staticmethod
+    def __body_id(body):
+        """ Reads the id off a JSON body, where it is the first key as keys are sorted """
+        if body.startswith('{"id":'):
+            end = body.find(',', 6)
+            if end > 0:
+                return int(body[6:end])
+        return json.loads(body)['id']
+
+    @staticmethod
+    def __decode(record):
+        """ Decodes a record with the codec named by its version byte """
+        return CODECS.get(record[:1], PickleCodec).decode(record)
+
+    @staticmethod
+    def __upgrade(node, records):
+        """ Rewrites (id, old, new) records on a node unless they changed in the meantime """
+        pipe = node.pipeline(transaction=False)
+        for order_id, old, new in records:
+            pipe.eval(UPGRADE_SCRIPT, 1, Order.key('order', order_id), old, new)
+        return sum(pipe.execute())
+
+    @staticmethod
+    def migrate_records():
+        """ Rewrites every record that is not stored with the current codec """
+        Order.logger.info('Migrating records to %s', Order.codec.__name__)
+        count = 0
+        for node in Order.ring.clients:
+            for keys in Order.__scan_keys(node):
+                legacy = []
+                for record in node.mget(keys):
+                    if record is not None and record[:1] != Order.codec.version:
+                        data = Order.__decode(record)
+                        legacy.append((data['id'], record, Order.codec.encode(data)))
+                if legacy:
+                    count += Order.__upgrade(node, legacy)
+        return count
+
+    @staticmethod
+    def migrate_namespace():
+        """
+        Moves the keys written before namespaces existed into the namespace
+
+        Records and the revision hashes are renamed, the id counter is
+        carried over and the old indexes are rebuilt inside the namespace.
+        The old keys live on the primary, so the records belonging to
+        other nodes are then rebalanced. Returns the number of records moved.
+        """
+        Order.logger.info('Moving un-namespaced Orders into %s', Order.namespace)
+        count = 0
+        for key in Order.redis.scan_iter(match='[0-9]*', count=Order.batch_size):
+            if key.isdigit() and Order.redis.renamenx(key, Order.key('order', key)):
+                count += 1
+        last_id = int(Order.redis.get('index') or 0)
+        if last_id > int(Order.redis.get(Order.key('index')) or 0):
+            Order.redis.set(Order.key('index'), last_id)
+        Order.redis.delete('index')
+        for name in ['revision', 'modified', 'generation']:
+            if Order.redis.exists(name):
+                Order.redis.renamenx(name, Order.key(name))
+        for pattern in ['ids'] + ['{}:*'.format(attribute) for attribute in Order.indexes]:
+            for keys in Order.__scan_keys(Order.redis, pattern):
+                Order.redis.delete(*keys)
+        Order.rebuild_indexes()
+        Order.rebalance()
+        return count
+
+    @staticmethod
+    def rebalance():
+        """
+        Moves every Order that is stored on a node other than its own
+
+        Run after adding or removing a node. A record is only copied if
+        its node does not hold a newer one, and is then removed with its
+        index entries from where it was. Returns the number of Orders moved.
+        """
+        Order.logger.info('Rebalancing Orders over %d nodes', len(Order.ring.clients))
+        count = 0
+        for node in Order.ring.clients:
+            for order in list(Order.__scan(node)):
+                target = Order.__node(order.id)
+                if target is node:
+                    continue
+                key = Order.key('order', order.id)
+                data = order.serialize()
+
+                def copy(pipe):
+                    exists = pipe.exists(key)
+                    pipe.multi()
+                    if not exists:
+                        Order.__put(pipe, data)
+                        Order.__touch(pipe)
+                        Order.__publish(pipe, order.id)
+
+                target.transaction(copy, key)
+                node.transaction(order.__erase, key)
+                Order.cache.invalidate(order.id)
+                count += 1
+        return count
+
+######################################################################
+#  S E C O N D A R Y   I N D E X E S
+######################################################################
+
+    @staticmethod
+    def __index_value(value):
+        """ Normalizes a value for use in an index key (ASCII case-insensitive) """
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return str(value).lower()
+
+    @staticmethod
+    def __index_key(attribute, value):
+        """ Returns the key of the sorted set holding ids with this value """
+        return Order.key(attribute, Order.__index_value(value))
+
+    @staticmethod
+    def __entries(data):
+        """ Returns the (key, member, score) of every index entry the Order has """
+        order_id = data['id']
+        # every id, in id order, for paging through all Orders
+        entries = [(Order.key('ids'), order_id, order_id)]
+        for attribute in Order.indexes:
+            entries.append((Order.__index_key(attribute, data[attribute]), order_id, order_id))
+        timestamp = Order.parse_time(data['time'])
+        if timestamp is not None:   # times that do not parse are only found by exact match
+            entries.append((Order.key('timestamps'), order_id, timestamp))
+            entries.append((Order.key('timeline'), Order.__timeline_member(timestamp, order_id), 0))
+        return entries
+
+    @staticmethod
+    def __timeline_member(timestamp, order_id):
+        """
+        Returns the member of an Order in the timeline index
+
+        Every member of the timeline has the score 0, so Redis keeps them
+        sorted as text: the microseconds since year 1 and the id, both zero
+        padded, order the Orders by time and then by id, and every page of
+        a time range is a single ZRANGEBYLEX from where the last one ended.
+        PATCH_SCRIPT builds the same member from a timestamp.
+        """
+        position = max(0, math.floor((timestamp + TIMELINE_OFFSET) * 1000000))
+        return '%020d:%020d' % (position, order_id)
+
+    @staticmethod
+    def __index(pipe, data):
+        """ Adds the Order's id to every index it belongs to """
+        for key, member, score in Order.__entries(data):
+            pipe.zadd(key, {member: score})
+        Order.__count(pipe, data, 1)
+
+    @staticmethod
+    def __unindex(pipe, data):
+        """ Removes the Order's id from every index it belongs to """
+        for key, member, _ in Order.__entries(data):
+            pipe.zrem(key, member)
+        Order.__count(pipe, data, -1)
+
+    @staticmethod
+    def __count(pipe, data, amount):
+        """
+        Queues the update of the statistics for an Order added (1) or removed (-1)
+
+        The Orders per status are kept in a hash and the Orders per
+        customer in a sorted set, which drops customers left with none.
+        """
+        pipe.hincrby(Order.key('counts'), Order.__index_value(data['status']), amount)
+        pipe.zincrby(Order.key('customers'), amount, data['name'])
+        if amount < 0:
+            pipe.zremrangebyscore(Order.key('customers'), '-inf', 0)
+
+    @staticmethod
+    def parse_time(value):
+        """ Returns the POSIX timestamp of an ISO 8601 time, or None if it is not one """
+        if not isinstance(value, basestring):
+            return None
+        match = TIME_FORMAT.match(value.strip())
+        if not match:
+            return None
+        year, month, day, hour, minute, second, fraction, offset = match.groups()
+        try:
+            moment = datetime(int(year), int(month), int(day), int(hour or 0),
+                              int(minute or 0), int(second or 0))
+        except ValueError:
+            return None
+        timestamp = calendar.timegm(moment.timetuple()) + float(fraction or 0)
+        if offset and offset.upper() != 'Z':
+            sign = -1 if offset[0] == '-' else 1
+            digits = offset[1:].replace(':', '')
+            timestamp -= sign * (int(digits[:2]) * 3600 + int(digits[2:]) * 60)
+        return timestamp
+
+    @staticmethod
+    def __index_keys(node):
+        """ Returns the keys of every index set on a node """
+        keys = []
+        for key in [Order.key('ids'), Order.key('timestamps'), Order.key('timeline')]:
+            if node.exists(key):
+                keys.append(key)
+        for attribute in Order.indexes:
+            keys.extend(node.scan_iter(match=Order.key(attribute, '*')))
+        return keys
+
+    @staticmethod
+    def rebuild_indexes():
+        """ Drops and rebuilds every index (and missing revision) from the stored Orders """
+        Order.logger.info('Rebuilding indexes for %s', ', '.join(Order.indexes))
+        count = 0
+        for node in Order.ring.clients:
+            for key in Order.__index_keys(node):
+                node.delete(key)
+            node.delete(Order.key('counts'), Order.key('customers'))
+            pipe = node.pipeline(transaction=False)
+            for order in Order.__scan(node):
+                Order.__index(pipe, order.serialize())
+                # Orders stored before revisions were kept start at revision 1
+                pipe.hsetnx(Order.key('revision'), order.id, 1)
+                pipe.hsetnx(Order.key('modified'), order.id, repr(time.time()))
+                count += 1
+                if count % Order.batch_size == 0:
+                    pipe.execute()
+            pipe.execute()
+        return count
+
+    @staticmethod
+    def check_indexes():
+        """
+        Compares the indexes with the stored Orders on every node
+
+        Returns a dictionary with the index entries that are 'missing'
+        for an Order and the 'stale' ones pointing at an Order that no
+        longer has that value (on that node). Both lists are empty when
+        consistent.
+        """
+        missing = []
+        stale = []
+        for node in Order.ring.clients:
+            expected = set()
+            for order in Order.__scan(node):
+                data = order.serialize()
+                for key, member, _ in Order.__entries(data):
+                    expected.add((key, str(member)))
+            actual = set()
+            for key in Order.__index_keys(node):
+                for member in node.zrange(key, 0, -1):
+                    actual.add((key, member))
+            missing.extend(expected - actual)
+            stale.extend(actual - expected)
+        return {
+            'missing': sorted(missing),
+            'stale': sorted(stale)
+        }
+
 ######################################################################
 #  F I N D E R   M E T H O D S
 ######################################################################
@@ -127,33 +1066,202 @@ class Order(object):
     @staticmethod
     def find(order_id):
         """ Query that finds Orders by their id """
-        if Order.redis.exists(order_id):
-            data = pickle.loads(Order.redis.get(order_id))
-            order = Order(data['id']).deserialize(data)
-            return order
-        return None
+        order_id = int(order_id)
+        cached = Order.cache.get(order_id)
+        if cached is not None:  # cached data was validated when first read
+            data, body, revision, modified = cached
+            if data is None:    # cached by find_json(), which does not decode
+                order = Order(order_id).deserialize(json.loads(body))
+            else:
+                order = Order(data['id'], data['name'], data['time'], data['status'])
+        else:
+            node, primary, record, revision, modified = Order.__fetch(order_id)
+            orders = Order.__from_records(node, [record])
+            if not orders:
+                return None
+            order = orders[0]
+            if primary:
+                Order.cache.put(order_id, (order.serialize(), Order.__body(order),
+                                           revision, modified))
+        order.revision = revision
+        order.modified = modified
+        return order
+
+    @staticmethod
+    def find_json(order_id):
+        """
+        Query that finds an Order by its id as the JSON it is stored as
+
+        Returns a (body, revision, modified) tuple, or None if there is no
+        such Order. The body is the compact JSON with sorted keys of
+        serialize(), taken from the record without decoding it.
+        """
+        order_id = int(order_id)
+        cached = Order.cache.get(order_id)
+        if cached is not None:
+            return cached[1:]
+        node, primary, record, revision, modified = Order.__fetch(order_id)
+        orders = Order.__bodies(node, [record])
+        if not orders:
+            return None
+        body = orders[0].json
+        if primary:
+            Order.cache.put(order_id, (None, body, revision, modified))
+        return body, revision, modified
+
+    @staticmethod
+    def __fetch(order_id):
+        """
+        Reads the record of an Order with its revision and modified time
+
+        Returns (node, primary, record, revision, modified), where primary
+        tells whether it was read from the node itself rather than a
+        replica, as a lagging replica could cache data a write just
+        invalidated.
+        """
+        node = Order.__node(order_id)
+        reader = Order.__reader(node)
+        pipe = reader.pipeline(transaction=False)
+        pipe.get(Order.key('order', order_id))
+        pipe.hget(Order.key('revision'), order_id)
+        pipe.hget(Order.key('modified'), order_id)
+        record, revision, modified = pipe.execute()
+        return (node, reader is node, record, int(revision or 0),
+                float(modified) if modified else None)
+
+    @staticmethod
+    def version(order_id):
+        """
+        Query that returns the revision of an Order without loading it
+
+        Returns a (revision, modified) tuple, where modified is the time
+        of the last write in epoch seconds, or None if the Order does not
+        exist or was stored before revisions were kept.
+        """
+        pipe = Order.__reader(Order.__node(order_id)).pipeline(transaction=False)
+        pipe.hget(Order.key('revision'), order_id)
+        pipe.hget(Order.key('modified'), order_id)
+        revision, modified = pipe.execute()
+        if revision is None:
+            return None
+        return int(revision), float(modified)
+
+    @staticmethod
+    def generation():
+        """
+        Query that returns the generation of the whole collection
+
+        The generation is bumped by every write, so listings that were
+        read at the same generation are identical. Each node counts its
+        own writes and the counts are added up. Returns a
+        (generation, modified) tuple like version().
+        """
+        generations = Order.ring.map(
+            lambda nodes: nodes[1].hmget(Order.key('generation'), 'count', 'modified'),
+            Order.__readers())
+        count = sum(int(count or 0) for count, _ in generations)
+        modified = [float(modified) for _, modified in generations if modified]
+        return count, max(modified) if modified else None
+
+    @staticmethod
+    def stats(top=10):
+        """
+        Query that returns the Order statistics every write keeps up to date
+
+        Returns a dictionary with the 'total', 'open' and 'purchased'
+        counts and the top 'customers' as (name, count) pairs, most
+        Orders first, read without looking at a single Order.
+        """
+        def read(nodes):
+            pipe = nodes[1].pipeline(transaction=False)
+            pipe.hmget(Order.key('counts'), 'true', 'false')
+            pipe.zrevrange(Order.key('customers'), 0, top - 1, withscores=True)
+            return pipe.execute()
+
+        readers = Order.__readers()
+        results = Order.ring.map(read, readers)
+        open_count = sum(max(0, int(counts[0] or 0)) for counts, _ in results)
+        purchased = sum(max(0, int(counts[1] or 0)) for counts, _ in results)
+        customers = {}
+        for _, found in results:
+            for name, count in found:
+                customers[name] = customers.get(name, 0) + int(count)
+        if len(readers) > 1 and customers:
+            # a customer's Orders are spread over the nodes, so the top
+            # customers of each node are counted on all of them
+            names = list(customers)
+
+            def count(nodes):
+                pipe = nodes[1].pipeline(transaction=False)
+                for name in names:
+                    pipe.zscore(Order.key('customers'), name)
+                return pipe.execute()
+
+            totals = Order.ring.map(count, readers)
+            customers = dict((name, sum(int(scores[index] or 0) for scores in totals))
+                             for index, name in enumerate(names))
+        ranked = sorted(customers.items(), key=lambda item: (-item[1], item[0]))
+        return {
+            'total': open_count + purchased,
+            'open': open_count,
+            'purchased': purchased,
+            'customers': ranked[:top]
+        }
 
     @staticmethod
     def __find_by(attribute, value):
         """ Generic Query that finds a key with a specific value """
         # return [order for order in Order.__data if order.time == time]
+        return list(Order.iter_by(attribute, value))
+
+    @staticmethod
+    def page(limit, after=0, attribute=None, value=None):
+        """
+        Query that returns one page of Orders in id order
+
+        Returns up to limit Orders with an id greater than after, matching
+        attribute == value when an attribute is given, together with the
+        id to pass as after for the next page (None on the last page).
+        """
+        key = Order.__index_key(attribute, value) if attribute else Order.key('ids')
+        return Order.__page(key, limit, after)
+
+    @staticmethod
+    def page_json(limit, after=0, attribute=None, value=None):
+        """ Query that returns one page of Orders like page(), as JSON bodies """
+        key = Order.__index_key(attribute, value) if attribute else Order.key('ids')
+        orders, next_after = Order.__page(key, limit, after, Order.__bodies)
+        return [order.json for order in orders], next_after
+
+    @staticmethod
+    def __page(key, limit, after, convert=None):
+        """ Loads up to limit Orders from an index on every node, starting after an id """
+        ranges = Order.ring.map(lambda nodes: nodes[1].zrangebyscore(
+            key, '({}'.format(after), '+inf', start=0, num=limit + 1), Order.__readers())
+        ids = sorted(set(int(order_id) for order_ids in ranges for order_id in order_ids))
+        next_after = ids[limit - 1] if len(ids) > limit else None
+        return Order.__load(ids[:limit], convert), next_after
+
+    @staticmethod
+    def iter_by(attribute, value):
+        """ Query that yields the Orders with attribute == value one batch at a time """
+        return Order.__iter_by(attribute, value, Order.__from_records)
+
+    @staticmethod
+    def find_json_by(attribute, value):
+        """ Query that returns the JSON bodies of the Orders with attribute == value """
+        return [order.json for order in Order.__iter_by(attribute, value, Order.__bodies)]
+
+    @staticmethod
+    def __iter_by(attribute, value, convert):
+        """ Generator over the Orders with attribute == value, as convert makes them """
         Order.logger.info('Processing %s query for %s', attribute, value)
-        if isinstance(value, str):
-            search_criteria = value.lower() # make case insensitive
-        else:
-            search_criteria = value
-        results = []
-        for key in Order.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Order.redis.get(key))
-                # perform case insensitive search on strings
-                if isinstance(data[attribute], str):
-                    test_value = data[attribute].lower()
-                else:
-                    test_value = data[attribute]
-                if test_value == search_criteria:
-                    results.append(Order(data['id']).deserialize(data))
-        return results
+        key = Order.__index_key(attribute, value)
+        after = 0
+        while after is not None:
+            orders, after = Order.__page(key, Order.batch_size, after, convert)
+            for order in orders:
+                yield order
 
     @staticmethod
     def find_by_name(name):
@@ -170,15 +1278,133 @@ class Order(object):
         """ Query that finds Orders by their availability """
         return Order.__find_by('status', status)
 
+    @staticmethod
+    def find_by_time_range(start=None, end=None):
+        """
+        Query that finds the Orders with a time from start to end, in time order
+
+        start and end are POSIX timestamps (None leaves that side open) and
+        both are included. Only times parse_time() understands are ranged
+        over; the others are still found by find_by_time().
+        """
+        return list(Order.iter_by_time_range(start, end))
+
+    @staticmethod
+    def find_json_by_time_range(start=None, end=None):
+        """ Query that returns the JSON bodies of find_by_time_range(), see find_json() """
+        return [order.json for order in Order.__iter_by_time_range(start, end, Order.__bodies)]
+
+    @staticmethod
+    def iter_by_time_range(start=None, end=None):
+        """ Query that yields the Orders of find_by_time_range() one batch at a time """
+        return Order.__iter_by_time_range(start, end, Order.__from_records)
+
+    @staticmethod
+    def page_json_by_time_range(limit, start=None, end=None, after=None):
+        """
+        Query that returns one page of find_by_time_range() as JSON bodies
+
+        Returns up to limit bodies following after, the opaque position
+        of the last Order of the previous page, together with the after
+        of the next page (None on the last page).
+        """
+        orders, next_after = Order.__time_page(limit, start, end, after, Order.__bodies)
+        return [order.json for order in orders], next_after
+
+    @staticmethod
+    def __iter_by_time_range(start, end, convert):
+        """ Generator over the Orders with a time from start to end, as convert makes them """
+        Order.logger.info('Processing time range query from %s to %s', start, end)
+        after = None
+        while True:
+            orders, after = Order.__time_page(Order.batch_size, start, end, after, convert)
+            for order in orders:
+                yield order
+            if after is None:
+                break
+
+    @staticmethod
+    def __time_page(limit, start, end, after, convert):
+        """
+        Loads up to limit Orders from the timeline index on every node
+
+        after is the timeline member the previous page ended with (see
+        __timeline_member()), so each node returns at most limit + 1
+        members whatever number of Orders share a time.
+        """
+        key = Order.key('timeline')
+        if after is not None:
+            low = '(' + after
+        elif start is not None:
+            low = '[' + Order.__timeline_member(start, 0)
+        else:
+            low = '-'
+        # ':' sorts before the digits of an id and ';' after all of them
+        high = '+' if end is None else '[' + Order.__timeline_member(end, 0)[:20] + ';'
+        ranges = Order.ring.map(lambda nodes: nodes[1].zrangebylex(
+            key, low, high, start=0, num=limit + 1), Order.__readers())
+        members = sorted(set(str(member) for found in ranges for member in found))
+        next_after = members[limit - 1] if len(members) > limit else None
+        ids = [int(member.split(':')[1]) for member in members[:limit]]
+        orders = dict((order.id, order) for order in Order.__load(ids, convert))
+        return [orders[order_id] for order_id in ids if order_id in orders], next_after
+
 ######################################################################
 #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
 ######################################################################
 
+    @staticmethod
+    def configure(config):
+        """ Applies the tuning settings found in a Flask style config """
+        Order.batch_size = int(config.get('REDIS_BATCH_SIZE', Order.batch_size))
+        namespace = config.get('ORDER_NAMESPACE', Order.namespace)
+        if not namespace or set(namespace) & set(':*?[]\\'):
+            raise ValueError("ORDER_NAMESPACE must not be empty or contain ':' or glob characters")
+        if namespace != Order.namespace:    # cached data and leased ids belong to the old one
+            Order.cache.clear()
+            Order.allocator.reset()
+        Order.namespace = namespace
+        Order.allocator.block_size = int(config.get('ID_BLOCK_SIZE', Order.allocator.block_size))
+        Order.redis_settings = dict((name, config[key]) for name, key in [
+            ('max_connections', 'REDIS_MAX_CONNECTIONS'),
+            ('pool_timeout', 'REDIS_POOL_TIMEOUT'),
+            ('socket_timeout', 'REDIS_SOCKET_TIMEOUT'),
+            ('socket_connect_timeout', 'REDIS_CONNECT_TIMEOUT'),
+            ('health_check_interval', 'REDIS_HEALTH_CHECK_INTERVAL'),
+            ('retries', 'REDIS_RETRIES'),
+            ('retry_backoff', 'REDIS_RETRY_BACKOFF')] if key in config)
+        Order.shard_urls = Order.__url_list(config.get('REDIS_NODES', Order.shard_urls))
+        Order.replica_urls = Order.__url_list(config.get('REDIS_REPLICAS', Order.replica_urls))
+        Order.cache.maxsize = int(config.get('ORDER_CACHE_SIZE', Order.cache.maxsize))
+        Order.cache.ttl = float(config.get('ORDER_CACHE_TTL', Order.cache.ttl))
+
+    @staticmethod
+    def __url_list(urls):
+        """ Returns a list of urls given as a list or a comma separated string """
+        if isinstance(urls, basestring):
+            urls = urls.split(',')
+        return [url.strip() for url in urls if url.strip()]
+
+    @staticmethod
+    def pool_stats():
+        """ Returns the usage counters of the connection pools, added up over the nodes """
+        totals = {}
+        for client in Order.ring.clients if Order.ring else []:
+            pool = client.connection_pool
+            if not hasattr(pool, 'stats'):
+                continue
+            for name, value in pool.stats().items():
+                if name.startswith('max_wait'):
+                    totals[name] = max(totals.get(name, 0), value)
+                else:
+                    totals[name] = totals.get(name, 0) + value
+        return totals
+
     @staticmethod
     def connect_to_redis(hostname, port, password):
         """ Connects to Redis and tests the connection """
         Order.logger.info("Testing Connection to: %s:%s", hostname, port)
-        Order.redis = Redis(host=hostname, port=port, password=password)
+        Order.redis = redis_pool.create_client(hostname, port, password, Order.redis_settings)
         try:
             Order.redis.ping()
             Order.logger.info("Connection established")
@@ -187,6 +1413,45 @@ class Order(object):
             Order.redis = None
         return Order.redis
 
+    @staticmethod
+    def connect_shards():
+        """
+        Builds the hash ring over the primary and the configured shards
+
+        The primary is always on the ring, so with no shards every Order
+        stays on it. Nodes are placed on the ring by their url, which
+        must therefore not change while they hold Orders. A shard's read
+        replicas follow its url separated by '|'.
+        """
+        nodes = [('primary', Order.redis)]
+        replicas = {'primary': Order.__connect_replicas(Order.replica_urls)}
+        for entry in Order.shard_urls:
+            urls = [url.strip() for url in entry.split('|')]
+            client = redis_pool.create_client_from_url(urls[0], Order.redis_settings)
+            try:
+                client.ping()
+            except ConnectionError:
+                Order.logger.error("Connection Error from shard %d", len(nodes))
+                raise ConnectionError('Could not connect to a Redis shard')
+            nodes.append((urls[0], client))
+            replicas[urls[0]] = Order.__connect_replicas(urls[1:])
+        Order.ring = HashRing(nodes, replicas=replicas)
+        Order.cache.listen(Order.ring.clients, Order.key('invalidate'), Order.allocator.release)
+
+    @staticmethod
+    def __connect_replicas(urls):
+        """ Connects to the read replicas that answer, the others are left out """
+        replicas = []
+        for url in urls:
+            client = redis_pool.create_client_from_url(url, Order.redis_settings)
+            try:
+                client.ping()
+                replicas.append(client)
+            except ConnectionError:
+                Order.logger.warning("Read replica %d is unreachable, reading from its primary",
+                                     len(replicas) + 1)
+        return replicas
+
     @staticmethod
     def init_db(redis=None):
         """
@@ -212,6 +1477,7 @@ class Order(object):
                 Order.logger.error("Client Connection Error!")
                 Order.redis = None
                 raise ConnectionError('Could not connect to the Redis Service')
+            Order.connect_shards()
             return
         # Get the credentials from the Bluemix environment
         if 'VCAP_SERVICES' in os.environ:
@@ -232,3 +1498,4 @@ class Order(object):
             # if you end up here, redis instance is down.
             Order.logger.fatal('*** FATAL ERROR: Could not connect to the Redis Service')
             raise ConnectionError('Could not connect to the Redis Service')
+        Order.connect_shards()
@@ -0,0 +1,211 @@
+"""
+Redis Connection Pool
+
+Clients built here share a fixed size blocking connection pool, so a
+busy worker waits for a free connection instead of opening new ones,
+and retry commands with exponential backoff while Redis is restarting
+(reads always, writes only when they never reached Redis).
+The pool keeps counters of its usage so it can be sized per worker, and
+every command (or pipeline) is reported to the functions in OBSERVERS.
+"""
+
+import time
+import logging
+import threading
+from redis import Redis
+from redis.connection import BlockingConnectionPool
+from redis.exceptions import ConnectionError, TimeoutError
+try:
+    from Queue import LifoQueue, Empty
+except ImportError:     # Python 3
+    from queue import LifoQueue, Empty
+
+logger = logging.getLogger(__name__)
+
+# Functions called with (command name, seconds) after every command or
+# pipeline, e.g. to record metrics; they must be fast and must not raise
+OBSERVERS = []
+
+# Settings used when the configuration does not override them
+DEFAULTS = {
+    'max_connections': 10,          # connections per worker process
+    'pool_timeout': 5,              # seconds to wait for a free connection
+    'socket_timeout': 5,            # seconds to wait for a reply
+    'socket_connect_timeout': 2,    # seconds to wait for a connection
+    'health_check_interval': 30,    # seconds idle before a connection is PINGed
+    'retries': 3,                   # attempts per command while Redis is down
+    'retry_backoff': 0.1            # seconds before the first retry, doubled each time
+}
+
+# Commands that only read, so they can be sent again when their reply is
+# lost; a write may already have been applied (an EVALSHA purchase or an
+# INCRBY of the id counter would then run twice)
+READ_COMMANDS = frozenset([
+    'GET', 'MGET', 'EXISTS', 'TYPE', 'TTL', 'PTTL', 'HGET', 'HMGET', 'HGETALL', 'HEXISTS',
+    'HLEN', 'ZRANGE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE', 'ZRANGEBYLEX',
+    'ZSCORE', 'ZCARD', 'ZCOUNT', 'SCAN', 'PING', 'INFO'
+])
+
+class PoolTimeoutError(ConnectionError):
+    """ No connection of the pool became free within its timeout """
+    pass
+
+class PoolQueue(LifoQueue):
+    """ The pool's queue of free connections, telling a timed out wait apart """
+
+    def get(self, block=True, timeout=None):
+        try:
+            return LifoQueue.get(self, block, timeout)
+        except Empty:
+            raise PoolTimeoutError('No connection available.')
+
+######################################################################
+# Connection Pool with usage statistics
+######################################################################
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    """ A BlockingConnectionPool that counts waits and connections in use """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('queue_class', PoolQueue)
+        super(InstrumentedConnectionPool, self).__init__(**kwargs)
+
+    def reset(self):
+        """ Resets the pool, also called in a forked child """
+        super(InstrumentedConnectionPool, self).reset()
+        self._stats_lock = threading.Lock()
+        self._checked_out = set()   # ids of the connections handed out
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        """ Checks out a connection, waiting up to timeout for a free one """
+        start = time.time()
+        connection = super(InstrumentedConnectionPool, self).get_connection(*args, **kwargs)
+        waited = time.time() - start
+        with self._stats_lock:
+            self._checked_out.add(id(connection))
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return connection
+
+    def release(self, connection):
+        """ Returns a connection to the pool """
+        # the base class also releases a connection that failed to connect
+        # before it was handed out, which must not count as one returned
+        with self._stats_lock:
+            if id(connection) in self._checked_out:
+                self._checked_out.remove(id(connection))
+                self.in_use -= 1
+        super(InstrumentedConnectionPool, self).release(connection)
+
+    def stats(self):
+        """ Returns the usage counters of the pool """
+        with self._stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'created': len(self._connections),
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'checkouts': self.checkouts,
+                'wait_seconds': round(self.wait_seconds, 6),
+                'max_wait_seconds': round(self.max_wait_seconds, 6)
+            }
+
+######################################################################
+# Client that reconnects with backoff
+######################################################################
+class ReconnectingRedis(Redis):
+    """
+    A Redis client that retries a command while Redis is unreachable
+
+    A command is sent again only if it failed before it was sent (while
+    connecting) or if it is in READ_COMMANDS, as a write whose reply was
+    lost may already have been applied. Waiting in vain for a free
+    connection (PoolTimeoutError) is never retried.
+    """
+
+    def __init__(self, retries=1, retry_backoff=0, **kwargs):
+        super(ReconnectingRedis, self).__init__(**kwargs)
+        self.retries = max(1, retries)
+        self.retry_backoff = retry_backoff
+
+    def execute_command(self, *args, **options):
+        """ Executes a command, reconnecting with backoff on connection errors """
+        command = args[0]
+        pool = self.connection_pool
+        delay = self.retry_backoff
+        start = time.time()
+        try:
+            for attempt in xrange(1, self.retries + 1):
+                connection = None
+                sent = False
+                try:
+                    connection = self.connection or pool.get_connection(command, **options)
+                    sent = True
+                    connection.send_command(*args)
+                    return self.parse_response(connection, command, **options)
+                except PoolTimeoutError:
+                    raise
+                except (ConnectionError, TimeoutError) as error:
+                    if connection is not None:
+                        connection.disconnect()
+                    if attempt == self.retries or (sent and command not in READ_COMMANDS):
+                        raise
+                    logger.warning('Redis %s failed (%s), retrying in %.2fs', command, error, delay)
+                    time.sleep(delay)
+                    delay *= 2
+                finally:
+                    if connection is not None and not self.connection:
+                        pool.release(connection)
+        finally:
+            observe(command, time.time() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        """ Returns a pipeline whose execution is reported as one MULTI or PIPELINE command """
+        pipe = super(ReconnectingRedis, self).pipeline(transaction, shard_hint)
+        execute = pipe.execute
+
+        def observed_execute(*args, **kwargs):
+            start = time.time()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                observe('MULTI' if transaction else 'PIPELINE', time.time() - start)
+
+        pipe.execute = observed_execute
+        return pipe
+
+def observe(command, seconds):
+    """ Reports a command to the observers """
+    for observer in OBSERVERS:
+        observer(command, seconds)
+
+def pool_options(settings=None):
+    """ Returns the pool keyword arguments and the retry settings """
+    options = dict(DEFAULTS, **(settings or {}))
+    return dict(
+        max_connections=options['max_connections'],
+        timeout=options['pool_timeout'],
+        socket_timeout=options['socket_timeout'],
+        socket_connect_timeout=options['socket_connect_timeout'],
+        socket_keepalive=True,
+        health_check_interval=options['health_check_interval']
+    ), dict(retries=options['retries'], retry_backoff=options['retry_backoff'])
+
+def create_client(host, port, password, settings=None):
+    """ Creates a client with its own pool from the given settings """
+    kwargs, retry = pool_options(settings)
+    pool = InstrumentedConnectionPool(host=host, port=int(port), password=password, **kwargs)
+    return ReconnectingRedis(connection_pool=pool, **retry)
+
+def create_client_from_url(url, settings=None):
+    """ Creates a client for a redis:// url with its own pool from the given settings """
+    kwargs, retry = pool_options(settings)
+    pool = InstrumentedConnectionPool.from_url(url, **kwargs)
+    return ReconnectingRedis(connection_pool=pool, **retry)
@@ -22,22 +22,38 @@ Paths:
 GET / - Displays a UI for Selenium testing
 GET /orders - Returns a list all of the Orders
 GET /orders/{id} - Returns the Order with a given id number
+GET /orders/stats - Returns the Order counts by status and the top customers
 POST /orders - creates a new Order record in the database
+POST /orders/batch - creates many Order records in the database
 PUT /orders/{id} - updates a Order record in the database
+PATCH /orders/{id} - updates some fields of a Order record in the database
 DELETE /orders/{id} - deletes a Order record in the database
+GET /metrics - Returns the service metrics in the Prometheus format
 """
 
+import re
 import sys
+import base64
 import logging
-from flask import jsonify, request, json, url_for, make_response, abort
+from datetime import datetime
+from flask import jsonify, request, json, url_for, make_response, abort, g
 from flask_api import status    # HTTP Status Codes
 from werkzeug.exceptions import NotFound
-from app.models import Order
+from app.models import Order, NOT_FOUND, NOT_AVAILABLE
+from app.custom_exceptions import DataValidationError
+from app import timing
 from . import app
 
+# Cookie that routes a client's reads to the primaries after it wrote
+READ_YOUR_WRITES_COOKIE = 'orders_read_your_writes'
+
+# The strings, punctuation and other values (numbers, literals) of compact JSON
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\],:]|[^{}\[\],:"]+')
+
 # Error handlers reuire app to be initialized so we must import
 # then only after we have initialized the Flask app instance
 import error_handlers
+import metrics
 
 ######################################################################
 # GET HEALTH CHECK
@@ -45,7 +61,8 @@ import error_handlers
 @app.route('/healthcheck')
 def healthcheck():
     """ Let them know our heart is still beating """
-    return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
+    return make_response(jsonify(status=200, message='Healthy', pool=Order.pool_stats(),
+                                 cache=Order.cache.stats()), status.HTTP_200_OK)
 
 ######################################################################
 # GET INDEX
@@ -69,6 +86,9 @@ def list_orders():
     tags:
       - Orders
     description: The Orders endpoint allows you to query Orders
+    produces:
+      - application/json
+      - application/x-ndjson
     parameters:
       - name: name
         in: query
@@ -85,9 +105,41 @@ def list_orders():
         description: the status of the order
         required: false
         type: boolean
+      - name: time_from
+        in: query
+        description: only Orders with an ISO 8601 time at or after this one, in time order
+        required: false
+        type: string
+      - name: time_to
+        in: query
+        description: only Orders with an ISO 8601 time at or before this one, in time order
+        required: false
+        type: string
+      - name: limit
+        in: query
+        description: the maximum number of Orders to return in one page
+        required: false
+        type: integer
+      - name: cursor
+        in: query
+        description: the opaque cursor taken from the next link of the previous page
+        required: false
+        type: string
+      - name: stream
+        in: query
+        description: stream one Order per line as NDJSON (same as Accept application/x-ndjson)
+        required: false
+        type: boolean
     responses:
       200:
         description: An array of Orders
+        headers:
+          Link:
+            type: string
+            description: the URL of the next page (rel="next") when paging with limit
+          ETag:
+            type: string
+            description: weak validator that changes with every write to any Order
         schema:
           type: array
           items:
@@ -106,18 +158,147 @@ def list_orders():
                 status:
                   type: boolean
                   description: the status of the order
+      304:
+        description: No Order changed since the ETag or date in If-None-Match / If-Modified-Since
     """
-    orders = []
     time = request.args.get('time')
     name = request.args.get('name')
+    # every write bumps the generation, so an unchanged one means an unchanged listing
+    generation, modified = Order.generation()
+    etag = 'orders.{}.{}'.format(version_tag(generation, modified),
+                                 'ndjson' if wants_ndjson() else 'json')
+    if is_not_modified(etag, modified):
+        return not_modified(etag, modified)
+    if 'time_from' in request.args or 'time_to' in request.args:
+        return conditional(list_orders_in_range(time, name), etag, modified)
+    if 'limit' in request.args or 'cursor' in request.args:
+        return conditional(list_orders_page(time, name), etag, modified)
+    if wants_ndjson():
+        return conditional(list_orders_stream(time, name), etag, modified)
+    if time:
+        bodies = Order.find_json_by('time', time)
+    elif name:
+        bodies = Order.find_json_by('name', name)
+    else:
+        bodies = Order.all_json()
+
+    metrics.observe_list(query_name(time, name), len(bodies))
+    return conditional(jsonify_encoded(json_array(bodies)), etag, modified)
+
+def list_orders_stream(time, name):
+    """ Streams the Orders as NDJSON straight off the Redis scan """
     if time:
-        orders = Order.find_by_time(time)
+        orders = Order.iter_by('time', time)
     elif name:
-        orders = Order.find_by_name(name)
+        orders = Order.iter_by('name', name)
     else:
-        orders = Order.all()
+        orders = Order.iter_all()
+
+    return ndjson_response(orders, query_name(time, name))
+
+def list_orders_page(time, name):
+    """ Returns one page of Orders with a Link to the next one """
+    limit = page_limit()
+    after = decode_cursor(request.args.get('cursor'))
+    if time:
+        bodies, next_after = Order.page_json(limit, after, 'time', time)
+    elif name:
+        bodies, next_after = Order.page_json(limit, after, 'name', name)
+    else:
+        bodies, next_after = Order.page_json(limit, after)
+
+    metrics.observe_list(query_name(time, name), len(bodies))
+    response = jsonify_encoded(json_array(bodies))
+    if next_after is not None:
+        next_url = url_for('list_orders', time=time, name=name, limit=limit,
+                           cursor=encode_cursor(next_after), _external=True)
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
+
+
+def list_orders_in_range(time, name):
+    """ Returns the Orders with a time from time_from to time_to, in time order """
+    if time or name:
+        raise DataValidationError('time_from and time_to cannot be combined with time or name')
+    start = time_arg('time_from')
+    end = time_arg('time_to')
+    if start is not None and end is not None and start > end:
+        raise DataValidationError('time_from must not be after time_to')
+    if 'limit' in request.args or 'cursor' in request.args:
+        limit = page_limit()
+        after = decode_cursor(request.args.get('cursor'), 'time')
+        bodies, next_after = Order.page_json_by_time_range(limit, start, end, after)
+        metrics.observe_list('time_range', len(bodies))
+        response = jsonify_encoded(json_array(bodies))
+        if next_after is not None:
+            next_url = url_for('list_orders', time_from=request.args.get('time_from'),
+                               time_to=request.args.get('time_to'), limit=limit,
+                               cursor=encode_cursor(next_after), _external=True)
+            response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        return response
+    if wants_ndjson():
+        return ndjson_response(Order.iter_by_time_range(start, end), 'time_range')
+    bodies = Order.find_json_by_time_range(start, end)
+    metrics.observe_list('time_range', len(bodies))
+    return jsonify_encoded(json_array(bodies))
+
 
-    results = [order.serialize() for order in orders]
+######################################################################
+# ORDER STATISTICS
+######################################################################
+@app.route('/orders/stats', methods=['GET'])
+def get_order_stats():
+    """
+    Retrieve the Order statistics
+    This endpoint counts the Orders by status and customer without reading them
+    ---
+    tags:
+      - Orders
+    produces:
+      - application/json
+    parameters:
+      - name: top
+        in: query
+        description: how many of the customers with the most Orders to return (default 10)
+        required: false
+        type: integer
+    responses:
+      200:
+        description: The Order statistics
+        schema:
+          properties:
+            total:
+              type: integer
+              description: the number of Orders
+            open:
+              type: integer
+              description: the Orders not purchased yet (status true)
+            purchased:
+              type: integer
+              description: the purchased Orders (status false)
+            top_customers:
+              type: array
+              description: the customers with the most Orders, most first
+              items:
+                properties:
+                  name:
+                    type: string
+                  orders:
+                    type: integer
+      400:
+        description: top is out of range
+    """
+    top = request.args.get('top', 10, type=int)
+    if top < 1 or top > app.config['ORDERS_MAX_PAGE_SIZE']:
+        raise DataValidationError('top must be between 1 and {}'
+                                  .format(app.config['ORDERS_MAX_PAGE_SIZE']))
+    stats = Order.stats(top)
+    results = {
+        'total': stats['total'],
+        'open': stats['open'],
+        'purchased': stats['purchased'],
+        'top_customers': [{'name': name, 'orders': count} for name, count in stats['customers']]
+    }
     return make_response(jsonify(results), status.HTTP_200_OK)
 
 
@@ -159,13 +340,26 @@ def get_orders(id):
               type: boolean
               description: the status of the order
 
+      304:
+        description: Order not modified since the ETag or date in If-None-Match / If-Modified-Since
       404:
         description: Order not found
     """
-    order = Order.find(id)
-    if not order:
+    if request.if_none_match or request.if_modified_since:
+        version = Order.version(id)
+        if version:
+            etag = 'order.{}.{}'.format(id, version_tag(*version))
+            if is_not_modified(etag, version[1]):
+                return not_modified(etag, version[1])
+    found = Order.find_json(id)
+    if not found:
         raise NotFound("Order with id '{}' was not found.".format(id))
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    body, revision, modified = found
+    response = jsonify_encoded(body)
+    if revision:
+        etag = 'order.{}.{}'.format(id, version_tag(revision, modified))
+        conditional(response, etag, modified)
+    return response
 
 ######################################################################
 # ADD A NEW ORDER
@@ -244,6 +438,88 @@ def create_orders():
     return make_response(jsonify(message), status.HTTP_201_CREATED,
                          {'Location': location_url})
 
+######################################################################
+# ADD A BATCH OF NEW ORDERS
+######################################################################
+@app.route('/orders/batch', methods=['POST'])
+def create_orders_batch():
+    """
+    Creates a batch of Orders
+    This endpoint will create every Order in the posted array (or NDJSON lines)
+    or none of them if any is invalid
+    ---
+    tags:
+      - Orders
+    consumes:
+      - application/json
+      - application/x-ndjson
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            schema:
+              id: data
+    responses:
+      201:
+        description: Orders created, one result per posted item in the same order
+        schema:
+          type: array
+          items:
+            properties:
+              status:
+                type: integer
+                description: 201 for every created Order
+              location:
+                type: string
+                description: the URL of the created Order
+              order:
+                schema:
+                  id: Order
+      400:
+        description: Bad Request (one or more items were not valid, nothing was created)
+    """
+    if request.mimetype == 'application/x-ndjson':
+        items = [line for line in request.get_data().splitlines() if line.strip()]
+        parse = json.loads
+    else:
+        check_content_type('application/json')
+        items = request.get_json()
+        parse = None
+    if not isinstance(items, list) or not items:
+        raise DataValidationError('Batch must be a non-empty array of orders')
+    app.logger.info('Creating a batch of %d orders', len(items))
+
+    messages = {}   # index -> why the item is invalid
+    if parse:
+        documents = []
+        for index, item in enumerate(items):
+            try:
+                documents.append(parse(item))
+            except ValueError as error:
+                documents.append(None)
+                messages[index] = str(error)
+        items = documents
+    orders, problems = Order.deserialize_all(items)
+    for index, message in problems:
+        messages.setdefault(index, message)
+    if messages:
+        errors = [{'index': index, 'status': status.HTTP_400_BAD_REQUEST,
+                   'message': messages[index]} for index in sorted(messages)]
+        return make_response(jsonify(status=400, error='Bad Request',
+                                     message='{} of {} orders are invalid'.format(len(errors), len(items)),
+                                     errors=errors), status.HTTP_400_BAD_REQUEST)
+
+    Order.create_all(orders)
+    results = [{'status': status.HTTP_201_CREATED,
+                'location': url_for('get_orders', id=order.id, _external=True),
+                'order': order.serialize()} for order in orders]
+    return make_response(jsonify(results), status.HTTP_201_CREATED)
+
 
 ######################################################################
 # UPDATE AN EXISTING ORDER
@@ -316,6 +592,72 @@ def update_orders(id):
     order.save()
     return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
 
+######################################################################
+# UPDATE SOME FIELDS OF AN EXISTING ORDER
+######################################################################
+@app.route('/orders/<int:id>', methods=['PATCH'])
+def patch_orders(id):
+    """
+    Update some fields of a Order
+    This endpoint will update only the fields of a Order that are posted
+    ---
+    tags:
+      - Orders
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: id
+        in: path
+        description: ID of order to update
+        type: integer
+        required: true
+      - in: body
+        name: body
+        schema:
+          id: patch
+          properties:
+            name:
+              type: string
+              description: name for the Order
+            time:
+              type: string
+              description: the time of order palced
+            status:
+              type: boolean
+              description: the status of the order
+    responses:
+      200:
+        description: Order Updated
+        schema:
+          id: Order
+          properties:
+            id:
+              type: integer
+              description: unique id assigned internallt by service
+            name:
+              type: string
+              description: the order's cutomer name
+            time:
+              type: string
+              description: the time of order placed
+            status:
+              type: boolean
+              description: the status of the order
+      400:
+        description: Bad Request (the posted fields were not valid)
+      404:
+        description: Order not found
+    """
+    check_content_type('application/json')
+    data = request.get_json()
+    app.logger.info(data)
+    body = Order.patch(id, data)
+    if body is None:
+        raise NotFound("Order with id '{}' was not found.".format(id))
+    return jsonify_encoded(body)
+
 ######################################################################
 # DELETE AN ORDER
 ######################################################################
@@ -349,14 +691,12 @@ def delete_orders(id):
 @app.route('/orders/<int:id>/purchase', methods=['PUT'])
 def purchase_orders(id):
     """ Purchasing an Order makes it unstatus """
-    order = Order.find(id)
-    if not order:
+    outcome, body = Order.purchase(id)
+    if outcome == NOT_FOUND:
         abort(status.HTTP_404_NOT_FOUND, "Order with id '{}' was not found.".format(id))
-    if not order.status:
+    if outcome == NOT_AVAILABLE:
         abort(status.HTTP_400_BAD_REQUEST, "Order with id '{}' is not status.".format(id))
-    order.status = False
-    order.save()
-    return make_response(jsonify(order.serialize()), status.HTTP_200_OK)
+    return jsonify_encoded(body)
 
 ######################################################################
 # DELETE ALL PET DATA (for testing only)
@@ -374,8 +714,66 @@ def orders_reset():
 @app.before_first_request
 def init_db(redis=None):
     """ Initlaize the model """
+    Order.configure(app.config)
     Order.init_db(redis)
 
+@app.before_request
+def route_reads():
+    """
+    Reads from the primaries when the client must see its own writes
+
+    That is when it sends 'X-Read-Your-Writes: true' or still carries
+    the cookie set by a recent write, otherwise from the replicas.
+    """
+    Order.read_from_primary(
+        request.headers.get('X-Read-Your-Writes', '').lower() in ('1', 'true')
+        or READ_YOUR_WRITES_COOKIE in request.cookies)
+
+@app.after_request
+def remember_writes(response):
+    """ Marks a client that just wrote so it reads from the primaries for a while """
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400 \
+            and Order.ring and Order.ring.has_replicas:
+        response.set_cookie(READ_YOUR_WRITES_COOKIE, '1',
+                            max_age=app.config['READ_YOUR_WRITES_SECONDS'], httponly=True)
+    return response
+
+@app.before_request
+def start_timings():
+    """ Times the request's phases when Server-Timing or the slow request log is on """
+    if app.config.get('SERVER_TIMING') or app.config.get('SLOW_REQUEST_SECONDS'):
+        g.timings = timing.Timings()
+        timing.use(g.timings)
+
+@app.after_request
+def report_timings(response):
+    """ Adds the Server-Timing header and logs the request if it was slow """
+    timings = g.pop('timings', None)
+    if timings is None:
+        return response
+    timing.use(None)
+    if app.config.get('SERVER_TIMING'):
+        response.headers['Server-Timing'] = timings.header()
+    threshold = app.config.get('SLOW_REQUEST_SECONDS')
+    if threshold and timings.total() >= threshold:
+        app.logger.warning('Slow request %s %s took %.1fms (%s)', request.method,
+                           request.full_path, timings.total() * 1000, timings.summary())
+    return response
+
+@app.teardown_request
+def stop_timings(error=None):
+    """ Stops timing a request that failed before it had a response """
+    timing.use(None)
+
+class TimedJSONEncoder(app.json_encoder):
+    """ Counts the encoding of response bodies as the encode phase """
+
+    def encode(self, o):
+        with timing.Phase('encode'):
+            return super(TimedJSONEncoder, self).encode(o)
+
+app.json_encoder = TimedJSONEncoder
+
 # load sample data
 def data_load(payload):
     """ Loads a Order into the database """
@@ -386,6 +784,142 @@ def data_reset():
     """ Removes all Orders from the database """
     Order.remove_all()
 
+def version_tag(revision, modified):
+    """ Combines a revision with its write time so a reset database never repeats a tag """
+    return '{}.{}'.format(revision, int((modified or 0) * 1000))
+
+def is_not_modified(etag, modified):
+    """ Checks the request's If-None-Match / If-Modified-Since against a version """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and modified:
+        return datetime.utcfromtimestamp(int(modified)) <= request.if_modified_since
+    return False
+
+def conditional(response, etag, modified):
+    """ Adds the ETag and Last-Modified headers of a version to a response """
+    response.set_etag(etag, weak=True)
+    if modified:
+        response.last_modified = datetime.utcfromtimestamp(int(modified))
+    return response
+
+def not_modified(etag, modified):
+    """ Returns an empty 304 Not Modified response for a version """
+    return conditional(make_response('', status.HTTP_304_NOT_MODIFIED), etag, modified)
+
+def jsonify_encoded(body):
+    """
+    Returns the 200 OK response jsonify() gives for JSON encoded compact with sorted keys
+
+    When jsonify() would write the data that way (ASCII only, sorted keys)
+    the body is passed through as it is, or re-indented when jsonify()
+    pretty prints (see indent_json()); otherwise it is decoded and handed
+    to jsonify(), so the response is the same either way.
+    """
+    config = app.config
+    if not config['JSON_AS_ASCII'] or not config['JSON_SORT_KEYS']:
+        with timing.Phase('decode'):
+            data = json.loads(body)
+        return make_response(jsonify(data), status.HTTP_200_OK)
+    if config['JSONIFY_PRETTYPRINT_REGULAR'] and not request.is_xhr:
+        body = indent_json(body)
+    return app.response_class((body, '\n'), status.HTTP_200_OK,
+                              mimetype=config['JSONIFY_MIMETYPE'])
+
+def indent_json(body):
+    """
+    Re-indents compact JSON as jsonify() pretty prints it, without decoding it
+
+    That is json.dumps() with indent=2 and the separators (', ', ': '),
+    whose items end their line with the separator's trailing space.
+    """
+    tokens = JSON_TOKEN.findall(body)
+    parts = []
+    depth = 0
+    for position, token in enumerate(tokens):
+        if token == '{' or token == '[':
+            depth += 1
+            parts.append(token)
+            if tokens[position + 1] not in ('}', ']'):
+                parts.append('\n' + '  ' * depth)
+        elif token == '}' or token == ']':
+            depth -= 1
+            if tokens[position - 1] not in ('{', '['):
+                parts.append('\n' + '  ' * depth)
+            parts.append(token)
+        elif token == ',':
+            parts.append(', \n' + '  ' * depth)
+        elif token == ':':
+            parts.append(': ')
+        else:
+            parts.append(token)
+    return ''.join(parts)
+
+def json_array(bodies):
+    """ Joins JSON bodies into the compact JSON array of them """
+    return '[' + ','.join(bodies) + ']'
+
+def ndjson_response(orders, query):
+    """ Streams Orders one per line as NDJSON, counting them for the metrics """
+    def generate():
+        count = 0
+        for order in orders:
+            count += 1
+            yield json.dumps(order.serialize()) + '\n'
+        metrics.observe_list(query, count)
+    return app.response_class(generate(), status.HTTP_200_OK, mimetype='application/x-ndjson')
+
+def page_limit():
+    """ Returns the page size asked for with limit, checked against the maximum """
+    limit = request.args.get('limit', app.config['ORDERS_PAGE_SIZE'], type=int)
+    if limit < 1 or limit > app.config['ORDERS_MAX_PAGE_SIZE']:
+        raise DataValidationError('limit must be between 1 and {}'
+                                  .format(app.config['ORDERS_MAX_PAGE_SIZE']))
+    return limit
+
+def time_arg(name):
+    """ Returns the timestamp of an ISO 8601 time query parameter, None if absent """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    timestamp = Order.parse_time(value)
+    if timestamp is None:
+        raise DataValidationError('{} must be an ISO 8601 time: {}'.format(name, value))
+    return timestamp
+
+def query_name(time, name):
+    """ Names the kind of GET /orders query for the metrics """
+    return 'time' if time else 'name' if name else 'all'
+
+def wants_ndjson():
+    """ Checks whether the client asked for a streamed NDJSON listing """
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+def encode_cursor(after):
+    """ Encodes the id, or timeline position in time order, a page ended with into a cursor """
+    if isinstance(after, basestring):
+        return base64.urlsafe_b64encode('time:{}'.format(after))
+    return base64.urlsafe_b64encode('id:{}'.format(after))
+
+def decode_cursor(cursor, order='id'):
+    """ Decodes a cursor of a listing in id or time order back into where it ended """
+    if not cursor:
+        return 0 if order == 'id' else None
+    try:
+        prefix, after = base64.urlsafe_b64decode(str(cursor)).split(':', 1)
+        if prefix == order == 'id':
+            return int(after)
+        if prefix == order == 'time':
+            parts = after.split(':')
+            if len(parts) == 2 and all(len(part) == 20 and part.isdigit() for part in parts):
+                return after
+    except (TypeError, ValueError):
+        pass
+    raise DataValidationError('Invalid cursor: {}'.format(cursor))
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers['Content-Type'] == content_type:
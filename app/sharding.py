@@ -0,0 +1,101 @@
+"""
+Order Sharding
+
+Spreads Orders over several Redis nodes by consistent hashing of their
+id. Each node is placed on a hash ring many times (virtual nodes), so
+the keys are evenly spread and adding a node only moves the share of
+keys that the new node takes over. A node may have read replicas that
+reads can be spread over.
+"""
+
+import os
+import random
+import hashlib
+from bisect import bisect
+from multiprocessing.pool import ThreadPool
+from app import timing
+
+######################################################################
+# Consistent Hash Ring
+######################################################################
+class HashRing(object):
+    """ Routes keys to named Redis clients by consistent hashing """
+
+    pool_class = ThreadPool     # runs map(), run_gevent.py swaps in a greenlet pool
+    pool_size = 4               # calls map() runs at once (at least one per node), each
+                                # holding a pooled Redis connection while it runs
+
+    def __init__(self, nodes, vnodes=160, replicas=None):
+        """
+        nodes is a list of (name, client) pairs, the first one is the primary,
+        replicas maps a node's name to the clients of its read replicas
+        """
+        self.names = [name for name, _ in nodes]
+        self.clients = [client for _, client in nodes]
+        replicas = replicas or {}
+        self.__replicas = dict((id(client), replicas.get(name, [])) for name, client in nodes)
+        self.__pool = None
+        self.__pid = None
+        ring = []
+        for index, name in enumerate(self.names):
+            for vnode in xrange(vnodes):
+                ring.append((HashRing.hash('{}#{}'.format(name, vnode)), index))
+        ring.sort()
+        self.__hashes = [point for point, _ in ring]
+        self.__indexes = [index for _, index in ring]
+
+    @staticmethod
+    def hash(key):
+        """ Returns the position of a key on the ring """
+        return int(hashlib.md5(str(key)).hexdigest()[:8], 16)
+
+    def index(self, key):
+        """ Returns the index of the node that owns a key """
+        position = bisect(self.__hashes, HashRing.hash(key)) % len(self.__hashes)
+        return self.__indexes[position]
+
+    def node(self, key):
+        """ Returns the client of the node that owns a key """
+        return self.clients[self.index(key)]
+
+    @property
+    def has_replicas(self):
+        """ True when any node has read replicas """
+        return any(self.__replicas.values())
+
+    def replica(self, client):
+        """ Returns a random read replica of a node, or the node itself if it has none """
+        replicas = self.__replicas.get(id(client))
+        return random.choice(replicas) if replicas else client
+
+    def group(self, keys):
+        """ Groups keys by owner, returning a list of (client, keys) pairs """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.index(key), []).append(key)
+        return [(self.clients[index], groups[index]) for index in sorted(groups)]
+
+    def map(self, function, items=None):
+        """
+        Calls function on every client (or on every item) in parallel
+
+        Returns the results in the same order. Up to pool_size calls run
+        at once, even on a single node, so the batches of a large read
+        overlap; a single item is called directly on the calling thread.
+        """
+        items = self.clients if items is None else items
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        if self.__pid != os.getpid():   # pool threads do not survive a fork
+            self.__pool = HashRing.pool_class(max(len(self.clients), HashRing.pool_size))
+            self.__pid = os.getpid()
+        timings = timing.current()
+
+        def call(item):     # the pool's threads report into the caller's request timings
+            timing.use(timings)
+            try:
+                return function(item)
+            finally:
+                timing.use(None)
+
+        return self.__pool.map(call, items)
@@ -0,0 +1,88 @@
+"""
+Request Timing
+
+Breaks the time of a request down into phases: the Redis round trips,
+decoding records, validating Orders and encoding the JSON response.
+The model and the Redis client report into the Timings of the current
+thread, which is only set while a request is being timed, so the hooks
+cost a thread-local lookup otherwise.
+"""
+
+import time
+import threading
+from app import redis_pool
+
+# Phases in the order they are reported
+PHASES = ('redis', 'decode', 'validate', 'encode')
+
+_local = threading.local()
+
+######################################################################
+# Timings of one request
+######################################################################
+class Timings(object):
+    """ Seconds and counts per phase, added to from any thread """
+
+    def __init__(self):
+        self.start = time.time()
+        self.seconds = dict((name, 0.0) for name in PHASES)
+        self.counts = dict((name, 0) for name in PHASES)
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, count=1):
+        """ Adds time spent in a phase """
+        with self.lock:
+            self.seconds[name] += seconds
+            self.counts[name] += count
+
+    def total(self):
+        """ Returns the seconds since the request started """
+        return time.time() - self.start
+
+    def header(self):
+        """ Returns the Server-Timing header value, durations in milliseconds """
+        metrics = ['{};dur={:.2f};desc="{} calls"'.format(name, self.seconds[name] * 1000,
+                                                          self.counts[name])
+                   for name in PHASES if self.counts[name]]
+        metrics.append('total;dur={:.2f}'.format(self.total() * 1000))
+        return ', '.join(metrics)
+
+    def summary(self):
+        """ Returns the breakdown for a log line """
+        return ', '.join('{} {:.1f}ms/{}'.format(name, self.seconds[name] * 1000, self.counts[name])
+                         for name in PHASES if self.counts[name])
+
+def current():
+    """ Returns the Timings of this thread, or None when nothing is being timed """
+    return getattr(_local, 'timings', None)
+
+def use(timings):
+    """ Makes this thread report into timings (None to stop) """
+    _local.timings = timings
+
+class Phase(object):
+    """ Context manager adding the time spent inside to a phase of the current Timings """
+
+    __slots__ = ('name', 'timings', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = current()
+        self.start = None
+
+    def __enter__(self):
+        if self.timings is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timings is not None:
+            self.timings.add(self.name, time.time() - self.start)
+
+def record_redis(command, seconds):
+    """ Adds a Redis round trip to the current Timings """
+    timings = current()
+    if timings is not None:
+        timings.add('redis', seconds)
+
+redis_pool.OBSERVERS.append(record_redis)
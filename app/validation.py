@@ -0,0 +1,124 @@
+"""
+Order Validation
+
+A validator compiled once from a Cerberus schema into plain type checks.
+It keeps no state between calls, so one instance can be shared by every
+thread, and it reports errors in the same shape and words as Cerberus
+({field: [message]}). Schemas using rules it does not compile are
+checked with a new Cerberus Validator per call instead.
+"""
+
+from cerberus import Validator
+
+# Cerberus type names and the Python types they accept
+TYPES = {
+    'integer': (int, long),
+    'float': float,
+    'number': (int, long, float),
+    'string': basestring,
+    'boolean': bool,
+    'dict': dict,
+    'list': list
+}
+
+# Rules the compiled checks implement
+RULES = set(['type', 'required', 'nullable'])
+
+######################################################################
+# Compiled Validator
+######################################################################
+class CompiledValidator(object):
+    """ Validates documents against a schema without shared state """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.compiled = all(set(rules) <= RULES and rules.get('type') in TYPES
+                            for rules in schema.values())
+        # field -> (accepted types, type name, nullable)
+        self.__fields = dict((field, (TYPES.get(rules.get('type')), rules.get('type'),
+                                      rules.get('nullable', False)))
+                             for field, rules in schema.items())
+        self.__required = set(field for field, rules in schema.items()
+                              if rules.get('required') is True)
+
+    def errors(self, document, update=False):
+        """
+        Returns the errors of a dictionary as Cerberus reports them, empty when valid
+
+        With update the fields it holds are checked but none is required,
+        as with Cerberus' validate(document, update=True).
+        """
+        if not self.compiled:
+            validator = Validator(self.schema)  # a Validator keeps the state of its last call
+            validator.validate(document, update=update)
+            return validator.errors
+        found = []
+        for field in document:
+            rule = self.__fields.get(field)
+            if rule is None:
+                found.append(FieldError(field, None, 'unknown field'))
+                continue
+            types, name, nullable = rule
+            value = document[field]
+            if value is None:
+                if not nullable:
+                    found.append(FieldError(field, 'nullable', 'null value not allowed'))
+            elif not isinstance(value, types):
+                found.append(FieldError(field, 'type', 'must be of {} type'.format(name)))
+        if not update:
+            for field in self.__required - set(document):
+                found.append(FieldError(field, 'required', 'required field'))
+        if not found:
+            return {}
+        return FieldError.tree(found)
+
+######################################################################
+# Field Error
+######################################################################
+class FieldError(object):
+    """
+    One error of a field, ordered the way Cerberus orders its errors
+
+    Cerberus sorts its error list after every error it adds and then
+    builds and copies a dictionary from it. The same steps are taken
+    here, so even the (hash based) order in which Python 2 prints the
+    dictionary in a DataValidationError message stays the same.
+    """
+
+    def __init__(self, field, rule, message):
+        self.path = (field,)
+        self.schema_path = (field, rule) if rule else ()
+        self.message = message
+
+    def __lt__(self, other):
+        if self.path != other.path:
+            return FieldError.path_lt(self.path, other.path)
+        return FieldError.path_lt(self.schema_path, other.schema_path)
+
+    @staticmethod
+    def path_lt(first, second):
+        """ Compares paths like Cerberus does (str and unicode names are unordered) """
+        for x, y in zip(first, second):
+            if isinstance(x, type(y)):
+                if x != y:
+                    return x < y
+            elif isinstance(x, (int, long)):
+                return True
+            elif isinstance(y, (int, long)):
+                return False
+        return len(first) < len(second)
+
+    @staticmethod
+    def tree(found):
+        """ Returns the {field: [message]} dictionary of errors found in this order """
+        errors = []
+        for error in found:
+            errors.append(error)
+            errors.sort()
+        tree = {}
+        for error in errors:
+            tree[error.path[0]] = [error.message]
+        copied = {}     # copied entry by entry, as Cerberus' deepcopy does
+        for field, messages in tree.iteritems():
+            copied[field] = messages
+        return copied
@@ -0,0 +1,6 @@
+"""
+Order Service Benchmarks
+
+python -m benchmarks.load - drives the HTTP API with a mix of requests
+python -m benchmarks.micro - times the Order model paths
+"""
@@ -0,0 +1,338 @@
+"""
+Order Service Load Benchmark
+
+Seeds the service with orders and then drives a weighted mix of requests
+at a fixed concurrency, reporting the throughput and the p50/p95/p99
+latency of every endpoint as JSON:
+
+python -m benchmarks.load --orders 10000 --concurrency 16 --duration 30
+python -m benchmarks.load --mix get=80,create=20 --save-baseline baseline.json
+python -m benchmarks.load --baseline baseline.json     # exits 1 on a regression
+
+By default the app is driven in process through Flask's test client
+against the ORDER_NAMESPACE 'orders_load' of the configured Redis;
+--fake-redis uses an in-memory fakeredis instead (pip install
+'fakeredis[lua]', as orders are written by Lua scripts) so it runs
+offline, and --url drives a running service over HTTP. In process every
+order of the namespace is deleted before seeding; a running service
+keeps its orders unless --reset is given, and the benchmark deletes the
+orders it created when it is done.
+"""
+
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from itertools import count
+
+NAMESPACE = 'orders_load'
+
+# Endpoint of every operation in the mix, the weights are the default mix
+OPERATIONS = [
+    ('list', 'GET /orders', 10),
+    ('filter', 'GET /orders?name', 10),
+    ('get', 'GET /orders/<id>', 50),
+    ('create', 'POST /orders', 10),
+    ('update', 'PUT /orders/<id>', 10),
+    ('purchase', 'PUT /orders/<id>/purchase', 5),
+    ('delete', 'DELETE /orders/<id>', 5)
+]
+
+# Client errors that are not failures: the id may have been deleted by
+# another client in the meantime, or the order purchased already
+EXPECTED_ERRORS = {
+    'get': (404,),
+    'update': (404,),
+    'purchase': (400, 404)
+}
+
+######################################################################
+#  C L I E N T S
+######################################################################
+class InProcessClient(object):
+    """ Calls the app through Flask's test client, one per thread """
+
+    def __init__(self, redis=None):
+        from app import app, server
+        server.initialize_logging(logging.CRITICAL)    # request logging would dominate
+        # DELETE /orders/reset must not reach a local service's own orders
+        app.config['ORDER_NAMESPACE'] = NAMESPACE
+        server.init_db(redis)
+        if redis is not None:
+            # the first request would otherwise reconnect to the configured Redis
+            app._got_first_request = True
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        """ Sends a request and returns its status code and decoded JSON body """
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        resp = client.open(path, method=method, content_type='application/json',
+                           data=json.dumps(body) if body is not None else None)
+        return resp.status_code, json.loads(resp.data) if resp.data else None
+
+
+class HttpClient(object):
+    """ Calls a running service over HTTP with a keep-alive session per thread """
+
+    def __init__(self, url):
+        import requests
+        self.requests = requests
+        self.url = url.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        """ Sends a request and returns its status code and decoded JSON body """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.requests.Session()
+        resp = session.request(method, self.url + path, json=body)
+        return resp.status_code, resp.json() if resp.content else None
+
+######################################################################
+#  W O R K L O A D
+######################################################################
+class Workload(object):
+    """ Picks the requests of the mix and keeps track of the existing ids """
+
+    def __init__(self, client, mix, names, list_limit):
+        self.client = client
+        self.names = names
+        self.list_limit = list_limit
+        self.ids = []
+        self.lock = threading.Lock()
+        self.choices = []
+        for name, endpoint, _ in OPERATIONS:
+            self.choices.extend([(name, endpoint)] * mix.get(name, 0))
+        if not self.choices:
+            raise ValueError('The mix must give at least one operation a weight')
+
+    def new_order(self):
+        """ Returns the JSON of a random new order """
+        return {'name': random.choice(self.names), 'time': time.strftime('%m/%d'), 'status': True}
+
+    def seed(self, total, batch=500):
+        """ Creates total orders through POST /orders/batch """
+        while total > 0:
+            size = min(batch, total)
+            code, results = self.client.request(
+                'POST', '/orders/batch', [self.new_order() for _ in xrange(size)])
+            if code != 201:
+                raise RuntimeError('Seeding failed with status {}'.format(code))
+            with self.lock:
+                self.ids.extend(result['order']['id'] for result in results)
+            total -= size
+
+    def cleanup(self):
+        """ Deletes the orders the workload created that are still there """
+        with self.lock:
+            ids, self.ids = self.ids, []
+        for order_id in ids:
+            self.client.request('DELETE', '/orders/{}'.format(order_id))
+
+    def random_id(self, remove=False):
+        """ Returns an existing id (or 0 when none is left) """
+        with self.lock:
+            if not self.ids:
+                return 0
+            index = random.randrange(len(self.ids))
+            if remove:
+                self.ids[index] = self.ids[-1]
+                return self.ids.pop()
+            return self.ids[index]
+
+    def run(self, name):
+        """ Sends one request of an operation and returns its status code """
+        if name == 'list':
+            path = '/orders?limit={}'.format(self.list_limit) if self.list_limit else '/orders'
+            return self.client.request('GET', path)[0]
+        if name == 'filter':
+            return self.client.request('GET', '/orders?name={}'.format(random.choice(self.names)))[0]
+        if name == 'get':
+            return self.client.request('GET', '/orders/{}'.format(self.random_id()))[0]
+        if name == 'create':
+            code, order = self.client.request('POST', '/orders', self.new_order())
+            if code == 201:
+                with self.lock:
+                    self.ids.append(order['id'])
+            return code
+        if name == 'update':
+            order_id = self.random_id()
+            body = dict(self.new_order(), id=order_id)
+            return self.client.request('PUT', '/orders/{}'.format(order_id), body)[0]
+        if name == 'purchase':
+            return self.client.request('PUT', '/orders/{}/purchase'.format(self.random_id()))[0]
+        if name == 'delete':
+            return self.client.request('DELETE', '/orders/{}'.format(self.random_id(remove=True)))[0]
+        raise ValueError('Unknown operation {}'.format(name))
+
+######################################################################
+#  R E P O R T
+######################################################################
+def percentile(samples, fraction):
+    """ Returns the nearest-rank percentile of sorted samples """
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def summarize(latencies, errors, elapsed):
+    """ Builds the report of every endpoint from its latencies in seconds """
+    report = {}
+    for name, endpoint, _ in OPERATIONS:
+        samples = sorted(latencies.get(name, []))
+        if not samples:
+            continue
+        report[endpoint] = {
+            'requests': len(samples),
+            'errors': errors.get(name, 0),
+            'throughput': round(len(samples) / elapsed, 2),
+            'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(samples, 0.99) * 1000, 3)
+        }
+    return report
+
+def compare(results, baseline, tolerance):
+    """ Returns the regressions of results against a baseline beyond a tolerance """
+    regressions = []
+    for endpoint, expected in baseline.get('endpoints', {}).items():
+        actual = results['endpoints'].get(endpoint)
+        if not actual:
+            continue
+        if actual['throughput'] < expected['throughput'] * (1 - tolerance):
+            regressions.append('{} throughput {} < baseline {}'.format(
+                endpoint, actual['throughput'], expected['throughput']))
+        if actual['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            regressions.append('{} p95 {}ms > baseline {}ms'.format(
+                endpoint, actual['p95_ms'], expected['p95_ms']))
+    return regressions
+
+######################################################################
+#  B E N C H M A R K
+######################################################################
+def benchmark(workload, concurrency, total=None, duration=None):
+    """ Runs the mix from concurrency threads until total requests or duration seconds """
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+    issued = count()
+    deadline = time.time() + duration if duration else None
+
+    def worker():
+        while True:
+            if total is not None and next(issued) >= total:
+                return
+            if deadline is not None and time.time() >= deadline:
+                return
+            name, _ = random.choice(workload.choices)
+            start = time.time()
+            code = workload.run(name)
+            elapsed = time.time() - start
+            with lock:
+                latencies.setdefault(name, []).append(elapsed)
+                if code >= 400 and code not in EXPECTED_ERRORS.get(name, ()):
+                    errors[name] = errors.get(name, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return {
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'requests': sum(len(samples) for samples in latencies.values()),
+        'throughput': round(sum(len(samples) for samples in latencies.values()) / elapsed, 2),
+        'endpoints': summarize(latencies, errors, elapsed)
+    }
+
+def parse_mix(text):
+    """ Parses 'get=80,create=20' into a dictionary of weights """
+    if not text:
+        return dict((name, weight) for name, _, weight in OPERATIONS)
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in [operation[0] for operation in OPERATIONS]:
+            raise argparse.ArgumentTypeError('unknown operation {}'.format(name))
+        mix[name.strip()] = int(weight or 1)
+    return mix
+
+######################################################################
+#   M A I N
+######################################################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Order Service load benchmark')
+    parser.add_argument('--orders', type=int, default=1000, help='orders to seed')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=10000, help='requests to send')
+    parser.add_argument('--duration', type=float, help='seconds to run instead of --requests')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(''),
+                        help='weights of list,filter,get,create,update,purchase,delete')
+    parser.add_argument('--names', type=int, default=100, help='distinct customer names')
+    parser.add_argument('--list-limit', type=int, default=100,
+                        help='page size of the list requests, 0 lists every order')
+    parser.add_argument('--url', help='base url of a running service to drive over HTTP')
+    parser.add_argument('--reset', action='store_true',
+                        help='delete every order of the --url service before seeding')
+    parser.add_argument('--fake-redis', action='store_true', help='run in process on fakeredis')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--save-baseline', help='file to save the results to as a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed regression against the baseline (0.1 = 10%%)')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    if args.url:
+        client = HttpClient(args.url)
+    elif args.fake_redis:
+        import fakeredis
+        client = InProcessClient(fakeredis.FakeStrictRedis())
+    else:
+        client = InProcessClient()
+    names = ['customer-{}'.format(number) for number in xrange(args.names)]
+    workload = Workload(client, args.mix, names, args.list_limit)
+
+    # a running service may hold orders that are not ours to delete
+    cleanup = args.url and not args.reset
+    if not cleanup:
+        client.request('DELETE', '/orders/reset')
+    try:
+        workload.seed(args.orders)
+        results = benchmark(workload, args.concurrency,
+                            total=None if args.duration else args.requests,
+                            duration=args.duration)
+    finally:
+        if cleanup:
+            workload.cleanup()
+    results['orders'] = args.orders
+    results['mix'] = args.mix
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as output:
+            output.write(text + '\n')
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print >> sys.stderr, 'REGRESSION: ' + regression
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
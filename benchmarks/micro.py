@@ -0,0 +1,191 @@
+"""
+Order Model Microbenchmarks
+
+Times the model paths a request spends its CPU in (serialize, deserialize
+with the Cerberus validator, the record codecs) and the Redis round trips
+of save(), find(), find_json(), all() and find_by_name() at several
+dataset sizes, reporting ops/sec and the memory allocated per op as JSON:
+
+python -m benchmarks.micro --sizes 100,1000,10000
+python -m benchmarks.micro --fake-redis --output micro.json
+
+The Redis paths run in the ORDER_NAMESPACE 'orders_bench' (which is
+cleared) of the configured Redis, or of an in-memory fakeredis with
+--fake-redis (pip install 'fakeredis[lua]', save() runs a Lua script). Allocations are measured with tracemalloc where the
+interpreter has it; Python 2 reports the objects the garbage collector
+tracks that are left over per op instead (containers only, not bytes).
+"""
+
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+from app.models import Order, JsonCodec, PickleCodec
+from app import server
+
+try:
+    import tracemalloc
+except ImportError:     # Python 2 has no tracemalloc
+    tracemalloc = None
+
+NAMESPACE = 'orders_bench'
+
+######################################################################
+#  M E A S U R E M E N T
+######################################################################
+def calibrate(function, min_time):
+    """ Returns how many calls of function take at least min_time seconds """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            function()
+        if time.time() - start >= min_time or number >= 10 ** 7:
+            return number
+        number *= 10
+
+def allocations(function, number):
+    """ Returns the bytes and memory blocks allocated per call with tracemalloc """
+    if tracemalloc is None:
+        return gc_allocations(function, number)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start_size = tracemalloc.get_traced_memory()[0]
+    for _ in xrange(number):
+        function()
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return {
+        'peak_bytes_per_op': round(float(peak - start_size) / number, 1),
+        'net_blocks_per_op': round(float(blocks) / number, 2)
+    }
+
+def gc_allocations(function, number):
+    """ Returns the objects tracked by the garbage collector that each call left behind """
+    gc.collect()
+    gc.disable()    # nothing is freed behind our back while counting
+    try:
+        before = len(gc.get_objects())
+        for _ in xrange(number):
+            function()
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    return {
+        'net_gc_objects_per_op': round(float(after - before) / number, 2)
+    }
+
+def measure(function, min_time=0.2, repeat=3):
+    """ Times function, best of repeat runs, and measures its allocations """
+    number = calibrate(function, min_time)
+    best = None
+    gc.disable()    # a collection in one run would make it look slow
+    try:
+        for _ in xrange(repeat):
+            start = time.time()
+            for _ in xrange(number):
+                function()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    return {
+        'ops_per_sec': round(number / best, 1),
+        'usec_per_op': round(best / number * 1e6, 3),
+        'allocations': allocations(function, min(number, 1000))
+    }
+
+######################################################################
+#  B E N C H M A R K S
+######################################################################
+def codec_benchmarks(options):
+    """ Benchmarks the paths that do not touch Redis """
+    data = {'id': 1, 'name': 'customer-1', 'time': '09/15', 'status': True}
+    order = Order(**data)
+    records = dict((codec.__name__, codec.encode(data)) for codec in [JsonCodec, PickleCodec])
+    results = {
+        'serialize': measure(order.serialize, **options),
+        'deserialize': measure(lambda: Order().deserialize(data), **options)
+    }
+    for codec in [JsonCodec, PickleCodec]:
+        record = records[codec.__name__]
+        results[codec.__name__ + '.encode'] = measure(lambda: codec.encode(data), **options)
+        results[codec.__name__ + '.decode'] = measure(lambda: codec.decode(record), **options)
+    return results
+
+def seed(size, names):
+    """ Replaces the stored Orders with size new ones """
+    Order.remove_all()
+    Order.create_all([Order(0, 'customer-{}'.format(number % names), '09/15')
+                      for number in xrange(size)])
+
+def query_benchmarks(size, options):
+    """ Benchmarks the Redis round trips with size Orders stored """
+    names = max(1, size / 10)   # every name is shared by about ten Orders
+    seed(size, names)
+    ids = [order.id for order in Order.all()]
+    order = Order.find(ids[0])
+    results = {
+        'save': measure(order.save, **options),
+        'find': measure(lambda: Order.find(random.choice(ids)), **options),
+        'find_json': measure(lambda: Order.find_json(random.choice(ids)), **options),
+        'find_by_name': measure(lambda: Order.find_by_name(
+            'customer-{}'.format(random.randrange(names))), **options),
+        'all': measure(Order.all, **options)
+    }
+    cache_size = Order.cache.maxsize
+    Order.cache.maxsize = len(ids)
+    try:
+        results['find (cached)'] = measure(lambda: Order.find(random.choice(ids)), **options)
+    finally:
+        Order.cache.maxsize = cache_size
+        Order.cache.clear()
+    # creating grows the data set, so it runs last
+    results['create'] = measure(lambda: Order(0, 'customer-0', '09/15').save(), **options)
+    return results
+
+######################################################################
+#   M A I N
+######################################################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Order model microbenchmarks')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma separated numbers of stored orders')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds each timed run lasts at least')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs, the best one counts')
+    parser.add_argument('--fake-redis', action='store_true', help='run on fakeredis')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    args = parser.parse_args(argv)
+
+    options = {'min_time': args.min_time, 'repeat': args.repeat}
+    server.app.config['ORDER_NAMESPACE'] = NAMESPACE
+    server.app.config['ORDER_CACHE_SIZE'] = 0   # find() must reach Redis unless cached on purpose
+    if args.fake_redis:
+        import fakeredis
+        server.init_db(fakeredis.FakeStrictRedis())
+    else:
+        server.init_db()
+
+    results = {
+        'python': sys.version.split()[0],
+        'codec': codec_benchmarks(options),
+        'sizes': {}
+    }
+    for size in [int(size) for size in args.sizes.split(',')]:
+        results['sizes'][str(size)] = query_benchmarks(size, options)
+    Order.remove_all()
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,41 @@
+import os
 import logging
 SECRET_KEY = 'secret-for-dev'
-LOGGING_LEVEL = logging.INFO
\ No newline at end of file
+LOGGING_LEVEL = logging.INFO
+
+# Prefix of every Redis key (no ':'), so several services or test runs can share a Redis
+ORDER_NAMESPACE = os.getenv('ORDER_NAMESPACE', 'orders')
+
+# Redis tuning
+REDIS_BATCH_SIZE = int(os.getenv('REDIS_BATCH_SIZE', '500'))
+ID_BLOCK_SIZE = int(os.getenv('ID_BLOCK_SIZE', '100'))
+
+# Extra Redis nodes the orders are sharded over, comma separated redis:// urls
+REDIS_NODES = os.getenv('REDIS_NODES', '')
+
+# Read replicas of the primary, comma separated redis:// urls, and how many
+# seconds a client reads from the primaries after it wrote
+REDIS_REPLICAS = os.getenv('REDIS_REPLICAS', '')
+READ_YOUR_WRITES_SECONDS = int(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
+
+# Redis connection pool, one per worker process and node
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '10'))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', '5'))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', '2'))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+REDIS_RETRIES = int(os.getenv('REDIS_RETRIES', '3'))
+REDIS_RETRY_BACKOFF = float(os.getenv('REDIS_RETRY_BACKOFF', '0.1'))
+
+# Paging through GET /orders
+ORDERS_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', '100'))
+ORDERS_MAX_PAGE_SIZE = int(os.getenv('ORDERS_MAX_PAGE_SIZE', '1000'))
+
+# Per request timing: a Server-Timing header, and a warning for requests
+# slower than SLOW_REQUEST_SECONDS (0 disables it)
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'False') == 'True'
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '1'))
+
+# In-process cache in front of GET /orders/<id>, 0 disables it
+ORDER_CACHE_SIZE = int(os.getenv('ORDER_CACHE_SIZE', '1000'))
+ORDER_CACHE_TTL = float(os.getenv('ORDER_CACHE_TTL', '5'))
@@ -0,0 +1,73 @@
+"""
+Order Service Management Commands
+
+Maintenance tasks that run against the same Redis the service uses:
+
+python manage.py rebuild-indexes - rebuilds the secondary indexes from the stored Orders
+python manage.py check-indexes - reports index entries that are missing or stale
+python manage.py migrate-records - rewrites legacy pickle records with the current codec
+python manage.py migrate-namespace - moves keys written before namespaces into ORDER_NAMESPACE
+python manage.py rebalance - moves Orders to the node that owns them after REDIS_NODES changed
+"""
+
+import sys
+import argparse
+from app.models import Order
+from app import server
+
+######################################################################
+#  C O M M A N D S
+######################################################################
+def rebuild_indexes(args):
+    """ Rebuilds the secondary indexes """
+    count = Order.rebuild_indexes()
+    print 'Indexed {} orders'.format(count)
+    return 0
+
+def check_indexes(args):
+    """ Checks the secondary indexes against the stored Orders """
+    report = Order.check_indexes()
+    for key, order_id in report['missing']:
+        print 'missing: order {} is not in {}'.format(order_id, key)
+    for key, order_id in report['stale']:
+        print 'stale: {} points at order {}'.format(key, order_id)
+    if report['missing'] or report['stale']:
+        return 1
+    print 'Indexes are consistent'
+    return 0
+
+def migrate_records(args):
+    """ Rewrites legacy records with the current codec """
+    count = Order.migrate_records()
+    print 'Migrated {} orders'.format(count)
+    return 0
+
+def migrate_namespace(args):
+    """ Moves un-namespaced keys into the namespace """
+    count = Order.migrate_namespace()
+    print 'Moved {} orders into namespace {}'.format(count, Order.namespace)
+    return 0
+
+def rebalance(args):
+    """ Moves Orders to the node that owns them """
+    count = Order.rebalance()
+    print 'Moved {} orders'.format(count)
+    return 0
+
+COMMANDS = {
+    'rebuild-indexes': rebuild_indexes,
+    'check-indexes': check_indexes,
+    'migrate-records': migrate_records,
+    'migrate-namespace': migrate_namespace,
+    'rebalance': rebalance
+}
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Order Service management commands')
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    server.init_db()
+    sys.exit(COMMANDS[args.command](args))
@@ -1,14 +1,67 @@
 """
 Order Service Runner
 Start the Order Service and initializes logging
+
+With SERVER_MODE=production the service is served by gunicorn: a master
+process preloads the app and forks WEB_WORKERS workers, each with
+WEB_THREADS threads, and reloads them gracefully on SIGHUP and stops
+them gracefully on SIGTERM. Otherwise Flask's development server is used.
 """
 
 import os
+from redis.exceptions import ConnectionError
 from app import app, server
 
 # Pull options from environment
 DEBUG = (os.getenv('DEBUG', 'False') == 'True')
 PORT = os.getenv('PORT', '5000')
+SERVER_MODE = os.getenv('SERVER_MODE', 'development')
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '2'))  # each holds its own copy of the app
+WEB_THREADS = int(os.getenv('WEB_THREADS', '1'))
+WEB_PRELOAD = (os.getenv('WEB_PRELOAD', 'True') == 'True')
+WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', '30'))
+WEB_KEEPALIVE = int(os.getenv('WEB_KEEPALIVE', '5'))
+
+######################################################################
+#   P R O D U C T I O N   S E R V E R
+######################################################################
+def post_worker_init(worker):
+    """ Connects each worker to Redis once it has booted """
+    # runs init_db here instead of on the worker's first request, so no
+    # pool or connection is ever shared with the master; a worker that
+    # fails to boot would halt gunicorn, so an unreachable Redis is left
+    # to the first request, which retries init_db until it succeeds
+    try:
+        app.try_trigger_before_first_request_functions()
+    except ConnectionError as error:
+        worker.log.warning('Redis not reachable yet, connecting on the first request: %s', error)
+
+def serve_production():
+    """ Serves the app from pre-forked gunicorn workers """
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        """ Runs gunicorn on this app with the settings from the environment """
+
+        def load_config(self):
+            options = {
+                'bind': '0.0.0.0:{}'.format(PORT),
+                'workers': WEB_WORKERS,
+                'threads': WEB_THREADS,
+                'worker_class': 'gthread',
+                'preload_app': WEB_PRELOAD,
+                'timeout': WEB_TIMEOUT,
+                'graceful_timeout': WEB_TIMEOUT,
+                'keepalive': WEB_KEEPALIVE,
+                'post_worker_init': post_worker_init
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    ProductionServer().run()
 
 ######################################################################
 #   M A I N
@@ -18,4 +71,7 @@ if __name__ == "__main__":
     print " Order  S E R V I C E   R U N N I N G"
     print "****************************************"
     server.initialize_logging()
-    app.run(host='0.0.0.0', port=int(PORT), debug=DEBUG)
\ No newline at end of file
+    if SERVER_MODE == 'production':
+        serve_production()
+    else:
+        app.run(host='0.0.0.0', port=int(PORT), debug=DEBUG)
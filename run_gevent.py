@@ -0,0 +1,34 @@
+"""
+Order Service Runner (gevent)
+Serves the Order Service from a single process on gevent's cooperative
+WSGI server. The standard library is patched so every Redis round trip
+yields to the other requests instead of blocking the process, which
+lets one process hold thousands of slow clients.
+"""
+
+# patch sockets, threads and queues before anything imports them
+from gevent import monkey
+monkey.patch_all()
+
+import os
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from app import app, server
+from app.sharding import HashRing
+
+# Pull options from environment
+PORT = os.getenv('PORT', '5000')
+MAX_CLIENTS = int(os.getenv('GEVENT_MAX_CLIENTS', '10000'))
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    print "****************************************"
+    print " Order  S E R V I C E   R U N N I N G"
+    print "         (gevent, one process)"
+    print "****************************************"
+    server.initialize_logging()
+    HashRing.pool_class = Pool  # nodes are scanned and read by greenlets
+    http = WSGIServer(('0.0.0.0', int(PORT)), app, spawn=Pool(MAX_CLIENTS))
+    http.serve_forever()
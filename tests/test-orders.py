@@ -22,12 +22,14 @@ nosetests -v --with-spec --spec-color
 import unittest
 import os
 import json
+import pickle
 from mock import patch
 from redis import Redis, ConnectionError
 from werkzeug.exceptions import NotFound
-from app.models import Order
+from app.models import Order, JsonCodec, PickleCodec, PURCHASED, NOT_FOUND, NOT_AVAILABLE
 from app.custom_exceptions import DataValidationError
 from app import server  # to get Redis
+from app import redis_pool
 
 VCAP_SERVICES = os.getenv('VCAP_SERVICES', None)
 if not VCAP_SERVICES:
@@ -72,6 +74,32 @@ class TestOrders(unittest.TestCase):
         self.assertEqual(orders[0].time, "09/15")
         self.assertEqual(orders[0].status, True)
 
+    def test_add_orders_from_id_block(self):
+        """ Create Orders with ids leased in blocks """
+        with patch.object(Order.allocator, 'block_size', 10):
+            Order(0, "fred", "09/15").save()
+            Order(0, "kate", "06/06").save()
+            self.assertEqual(Order.redis.get(Order.key('index')), '10')
+            orders = Order.create_all([Order(0, "sammy", "04/14")])
+            self.assertEqual(orders[0].id, 3)
+        self.assertEqual([order.id for order in Order.all()], [1, 2, 3])
+
+    def test_add_orders_from_stale_id_block(self):
+        """ Create Orders without overwriting ids taken since the block was leased """
+        with patch.object(Order.allocator, 'block_size', 10):
+            Order(0, "fred", "09/15").save()
+            # as another worker would after the counter was reset
+            Order(2, "kate", "06/06").save()
+            order = Order(0, "sammy", "04/14")
+            order.save()
+            self.assertEqual(order.id, 11)
+            Order(13, "leo", "01/01").save()
+            orders = Order.create_all([Order(0, "mia", "02/02"), Order(0, "ned", "03/03")])
+            self.assertEqual([order.id for order in orders], [12, 21])
+        self.assertEqual(Order.find(2).name, "kate")
+        self.assertEqual(Order.find(13).name, "leo")
+        self.assertEqual(len(Order.all()), 6)
+
     def test_update_a_order(self):
         """ Update a Order """
         order = Order(0, "fred", "09/15", True)
@@ -130,6 +158,25 @@ class TestOrders(unittest.TestCase):
         order = Order(0)
         self.assertRaises(DataValidationError, order.deserialize, None)
 
+    def test_deserialize_error_message(self):
+        """ Report invalid fields the way Cerberus does """
+        data = {"name": "fred", "time": "09/15", "status": "yes", "color": "red"}
+        with self.assertRaises(DataValidationError) as context:
+            Order().deserialize(data)
+        self.assertIn("'status': ['must be of boolean type']", str(context.exception))
+        self.assertIn("'color': ['unknown field']", str(context.exception))
+        self.assertTrue(str(context.exception).startswith('Invalid order data: {'))
+
+    def test_deserialize_all(self):
+        """ Deserialize a batch of Orders, reporting the invalid ones """
+        items = [{"name": "fred", "time": "09/15", "status": True},
+                 {"name": "kate", "time": "06/06"},
+                 "string data"]
+        orders, problems = Order.deserialize_all(items)
+        self.assertEqual([order.name for order in orders], ["fred"])
+        self.assertEqual([index for index, _ in problems], [1, 2])
+        self.assertEqual(problems[0][1], "Invalid order data: {'status': ['required field']}")
+
     def test_deserialize_with_bad_data(self):
         """ Deserialize a Order that has bad data """
         order = Order(0)
@@ -140,6 +187,16 @@ class TestOrders(unittest.TestCase):
         order = Order(0, None, "06/06")
         self.assertRaises(DataValidationError, order.save)
 
+    @patch.object(Order, 'batch_size', 2)
+    def test_all_in_batches(self):
+        """ List all Orders across several SCAN pages """
+        for name in ["fred", "kate", "sammy", "tom", "ann"]:
+            Order(0, name, "09/15").save()
+        orders = Order.all()
+        self.assertEqual([order.id for order in orders], [1, 2, 3, 4, 5])
+        orders = Order.find_by_time("09/15")
+        self.assertEqual(len(orders), 5)
+
     def test_find_order(self):
         """ Find a Order by id """
         Order(0, "fred", "09/15").save()
@@ -178,6 +235,80 @@ class TestOrders(unittest.TestCase):
         self.assertEqual(orders[0].time, "06/06")
         self.assertEqual(orders[0].name, "kate")
 
+    def test_find_by_time_range(self):
+        """ Find Orders by a range of ISO 8601 times """
+        Order(0, "fred", "2017-09-15T10:00").save()
+        Order(0, "kate", "2017-06-06").save()
+        Order(0, "leo", "04/14").save()
+        Order(0, "mia", "2017-09-15 12:00+02:00").save()
+        self.assertEqual(Order.parse_time("1970-01-02"), 86400)
+        self.assertIsNone(Order.parse_time("04/14"))
+        orders = Order.find_by_time_range()
+        self.assertEqual([order.name for order in orders], ["kate", "fred", "mia"])
+        orders = Order.find_by_time_range(Order.parse_time("2017-09-15"))
+        self.assertEqual([order.name for order in orders], ["fred", "mia"])
+        orders = Order.find_by_time_range(end=Order.parse_time("2017-09-15T09:59"))
+        self.assertEqual([order.name for order in orders], ["kate"])
+        self.assertEqual(Order.find_by_time("04/14")[0].name, "leo")
+        bodies, after = Order.page_json_by_time_range(2)
+        self.assertEqual(len(bodies), 2)
+        bodies, after = Order.page_json_by_time_range(2, after=after)
+        self.assertEqual([json.loads(body)['name'] for body in bodies], ["mia"])
+        self.assertIsNone(after)
+
+    def test_stats(self):
+        """ Count Orders by status and customer """
+        Order(0, "fred", "09/15").save()
+        Order(0, "kate", "06/06").save()
+        order = Order(0, "fred", "04/14")
+        order.save()
+        order.status = False
+        order.save()
+        stats = Order.stats()
+        self.assertEqual(stats['total'], 3)
+        self.assertEqual(stats['open'], 2)
+        self.assertEqual(stats['purchased'], 1)
+        self.assertEqual(stats['customers'], [("fred", 2), ("kate", 1)])
+        Order.find(2).delete()
+        self.assertEqual(Order.stats(1)['customers'], [("fred", 2)])
+        self.assertEqual(Order.stats()['total'], 2)
+        Order.remove_all()
+        self.assertEqual(Order.stats()['total'], 0)
+
+    def test_purchase(self):
+        """ Purchase a Order atomically """
+        Order(0, "fred", "09/15").save()
+        outcome, body = Order.purchase(1)
+        self.assertEqual(outcome, PURCHASED)
+        self.assertEqual(json.loads(body)['status'], False)
+        order = Order.find(1)
+        self.assertEqual(order.status, False)
+        self.assertEqual(order.revision, 2)
+        self.assertEqual(len(Order.find_by_availability(False)), 1)
+        self.assertEqual(Order.stats()['purchased'], 1)
+        self.assertEqual(Order.purchase(1), (NOT_AVAILABLE, None))
+        self.assertEqual(Order.purchase(2), (NOT_FOUND, None))
+        with patch.object(Order, 'codec', PickleCodec):
+            Order(0, "kate", "06/06").save()
+            self.assertRaises(RuntimeError, Order.purchase, 2)
+
+    def test_patch(self):
+        """ Update some fields of a Order in place """
+        Order(0, "fred", "09/15").save()
+        body = Order.patch(1, {"name": "kate", "status": False})
+        self.assertEqual(json.loads(body), {"id": 1, "name": "kate", "time": "09/15",
+                                            "status": False})
+        order = Order.find(1)
+        self.assertEqual(order.name, "kate")
+        self.assertEqual(order.revision, 2)
+        self.assertEqual(Order.find_by_name("fred"), [])
+        self.assertEqual(Order.find_by_name("kate")[0].id, 1)
+        self.assertEqual(Order.check_indexes(), {'missing': [], 'stale': []})
+        self.assertEqual(Order.stats()['customers'], [("kate", 1)])
+        self.assertIsNone(Order.patch(2, {"name": "leo"}))
+        self.assertRaises(DataValidationError, Order.patch, 1, {"time": 1})
+        self.assertRaises(DataValidationError, Order.patch, 1, {})
+
     def test_find_by_availability(self):
         """ Find a Order by Availability """
         Order(0, "fred", "09/15", False).save()
@@ -197,6 +328,152 @@ class TestOrders(unittest.TestCase):
         self.assertNotEqual(len(orders), 0)
         self.assertEqual(orders[0].time, "06/06")
 
+    def test_find_by_name_after_update(self):
+        """ Find a Order by Name after it was renamed """
+        order = Order(0, "fred", "09/15")
+        order.save()
+        order.name = "Kate"
+        order.save()
+        self.assertEqual(Order.find_by_name("fred"), [])
+        orders = Order.find_by_name("kate")
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(orders[0].id, order.id)
+
+    def test_find_by_name_after_delete(self):
+        """ Find a Order by Name after it was deleted """
+        order = Order(0, "fred", "09/15")
+        order.save()
+        order.delete()
+        self.assertEqual(Order.find_by_name("fred"), [])
+
+    def test_rebuild_indexes(self):
+        """ Rebuild the indexes from the stored Orders """
+        Order(0, "fred", "09/15").save()
+        Order(0, "kate", "06/06").save()
+        Order.redis.delete(Order.key('name', 'fred'))
+        self.assertEqual(len(Order.check_indexes()['missing']), 1)
+        self.assertEqual(Order.rebuild_indexes(), 2)
+        self.assertEqual(Order.check_indexes(), {'missing': [], 'stale': []})
+        self.assertEqual(len(Order.find_by_name("fred")), 1)
+
+    def test_record_is_versioned_json(self):
+        """ Store a Order as versioned JSON """
+        Order(0, "fred", "09/15").save()
+        record = Order.redis.get(Order.key('order', 1))
+        self.assertEqual(record[:1], JsonCodec.version)
+        self.assertEqual(json.loads(record[1:])['name'], "fred")
+
+    def test_legacy_record_is_upgraded(self):
+        """ Read a legacy pickle record """
+        data = {"id": 1, "name": "fred", "time": "09/15", "status": True}
+        Order.redis.set(Order.key('order', 1), pickle.dumps(data))
+        order = Order.find(1)
+        self.assertEqual(order.name, "fred")
+        self.assertEqual(Order.redis.get(Order.key('order', 1))[:1], JsonCodec.version)
+
+    def test_migrate_records(self):
+        """ Migrate legacy pickle records """
+        for order_id in [1, 2]:
+            data = {"id": order_id, "name": "fred", "time": "09/15", "status": True}
+            Order.redis.set(Order.key('order', order_id), pickle.dumps(data))
+        self.assertEqual(Order.migrate_records(), 2)
+        self.assertEqual(Order.migrate_records(), 0)
+        self.assertEqual(Order.redis.get(Order.key('order', 2))[:1], JsonCodec.version)
+
+    def test_remove_all_keeps_other_namespaces(self):
+        """ Remove all Orders of one namespace only """
+        Order.redis.set('not-an-order', 'keep')
+        Order(0, "fred", "09/15").save()
+        with patch.object(Order, 'namespace', 'other'):
+            Order(0, "kate", "06/06").save()
+            self.assertEqual([order.name for order in Order.all()], ["kate"])
+        Order.remove_all()
+        self.assertEqual(Order.all(), [])
+        self.assertEqual(Order.redis.get('not-an-order'), 'keep')
+        with patch.object(Order, 'namespace', 'other'):
+            self.assertEqual([order.name for order in Order.all()], ["kate"])
+            Order.remove_all()
+        Order.redis.delete('not-an-order')
+
+    def test_migrate_namespace(self):
+        """ Move Orders stored before namespaces into the namespace """
+        data = {"id": 7, "name": "fred", "time": "09/15", "status": True}
+        Order.redis.set(7, JsonCodec.encode(data))
+        Order.redis.set('index', 7)
+        self.assertEqual(Order.migrate_namespace(), 1)
+        self.assertFalse(Order.redis.exists(7))
+        self.assertEqual(Order.find_by_name("fred")[0].id, 7)
+        Order(0, "kate", "06/06").save()
+        self.assertEqual(Order.find_by_name("kate")[0].id, 8)
+
+    def test_pool_stats(self):
+        """ Report the connection pool usage """
+        Order(0, "fred", "09/15").save()
+        Order.find(1)
+        stats = Order.pool_stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertGreater(stats['checkouts'], 0)
+        self.assertGreaterEqual(stats['max_connections'], stats['created'])
+
+    def test_pool_stats_after_failed_connect(self):
+        """ Report no connection in use after Redis could not be reached """
+        pool = redis_pool.InstrumentedConnectionPool(
+            host='127.0.0.1', port=1, max_connections=2, socket_connect_timeout=0.1)
+        client = redis_pool.ReconnectingRedis(connection_pool=pool, retries=2)
+        self.assertRaises(ConnectionError, client.get, 'fred')
+        self.assertRaises(ConnectionError, client.get, 'fred')
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+    def test_sharded_orders(self):
+        """ Spread Orders over two nodes and rebalance them """
+        for name in ["fred", "kate", "bob", "fred", "kate", "bob"]:
+            Order(0, name, "09/15").save()
+        self.addCleanup(Order.connect_shards)
+        with patch.object(Order, 'shard_urls', ['redis://127.0.0.1:6379/1']):
+            Order.connect_shards()
+            shard = Order.ring.clients[1]
+            for key in shard.scan_iter(match=Order.key('*')):
+                shard.delete(key)
+            moved = Order.rebalance()
+            self.assertEqual(len(list(shard.scan_iter(match=Order.key('order', '*')))), moved)
+            self.assertEqual([order.id for order in Order.all()], range(1, 7))
+            self.assertEqual(len(Order.find_by_name("fred")), 2)
+            self.assertEqual(Order.check_indexes(), {'missing': [], 'stale': []})
+            self.assertEqual(Order.rebalance(), 0)
+            Order.remove_all()
+            self.assertEqual(list(shard.scan_iter(match=Order.key('*'))), [])
+
+    def test_find_json(self):
+        """ Find Orders as their JSON bodies """
+        Order(0, "fred", "09/15").save()
+        Order(0, "kate", "06/06").save()
+        fred = JsonCodec.encode(Order.find(1).serialize())[1:]
+        kate = JsonCodec.encode(Order.find(2).serialize())[1:]
+        body, revision, modified = Order.find_json(2)
+        self.assertEqual(body, kate)
+        self.assertEqual(revision, 1)
+        self.assertIsNotNone(modified)
+        self.assertIsNone(Order.find_json(3))
+        self.assertEqual(Order.all_json(), [fred, kate])
+        self.assertEqual(Order.find_json_by('name', 'kate'), [kate])
+        self.assertEqual(Order.page_json(1), ([fred], 1))
+
+    def test_find_from_cache(self):
+        """ Find a Order through the cache """
+        Order(0, "fred", "09/15").save()
+        with patch.object(Order.cache, 'maxsize', 10):
+            Order.cache.clear()
+            self.assertEqual(Order.find(1).name, "fred")
+            hits = Order.cache.hits
+            self.assertEqual(Order.find(1).name, "fred")
+            self.assertEqual(Order.cache.hits, hits + 1)
+            order = Order.find(1)
+            order.name = "kate"
+            order.save()
+            self.assertEqual(Order.find(1).name, "kate")
+            order.delete()
+            self.assertIsNone(Order.find(1))
+
 #    @patch.dict(os.environ, {'VCAP_SERVICES': json.dumps(VCAP_SERVICES).encode('utf8')})
     @patch.dict(os.environ, {'VCAP_SERVICES': VCAP_SERVICES})
     def test_vcap_services(self):
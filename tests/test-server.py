@@ -22,12 +22,14 @@ nosetests -v --with-spec --spec-color
 import unittest
 import logging
 import json
+from mock import patch
 from app import server
 
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_405_METHOD_NOT_ALLOWED = 405
@@ -70,6 +72,67 @@ class TestOrderServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(data['name'], 'kate')
 
+    def test_get_order_body(self):
+        """ Get a Order passed through as jsonify would write it """
+        order = {'id': 2, 'name': 'kate', 'time': '06/06', 'status': True}
+        resp = self.app.get('/orders/2', headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.data, json.dumps(order, sort_keys=True, separators=(',', ':')) + '\n')
+        # pretty printed for other clients, still without decoding the record
+        with patch.object(server.json, 'loads', side_effect=AssertionError('decoded')):
+            resp = self.app.get('/orders/2')
+            self.assertEqual(resp.data, json.dumps(order, sort_keys=True, indent=2,
+                                                   separators=(', ', ': ')) + '\n')
+            resp = self.app.get('/orders')
+            data = json.loads(resp.data)
+            self.assertEqual(resp.data, json.dumps(data, sort_keys=True, indent=2,
+                                                   separators=(', ', ': ')) + '\n')
+        resp = self.app.get('/orders', headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(json.loads(resp.data)[1], order)
+        self.assertTrue(resp.data.endswith('}]\n'))
+
+    def test_get_order_stats(self):
+        """ Get the Order statistics """
+        server.data_load({"name": "fred", "time": "04/14", "status": True})
+        resp = self.app.put('/orders/2/purchase')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        resp = self.app.get('/orders/stats')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['open'], 2)
+        self.assertEqual(data['purchased'], 1)
+        self.assertEqual(data['top_customers'], [{'name': 'fred', 'orders': 2},
+                                                 {'name': 'kate', 'orders': 1}])
+        resp = self.app.get('/orders/stats', query_string='top=0')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_get_order_not_modified(self):
+        """ Get a Order with If-None-Match """
+        resp = self.app.get('/orders/2')
+        etag = resp.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        resp = self.app.get('/orders/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        data = json.dumps({'name': 'kate', 'time': '12/21', 'status': True})
+        self.app.put('/orders/2', data=data, content_type='application/json')
+        resp = self.app.get('/orders/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertNotEqual(resp.headers.get('ETag'), etag)
+
+    def test_get_order_list_not_modified(self):
+        """ Get the list of Orders with If-None-Match """
+        resp = self.app.get('/orders')
+        etag = resp.headers.get('ETag')
+        resp = self.app.get('/orders', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_304_NOT_MODIFIED)
+        self.app.delete('/orders/1')
+        resp = self.app.get('/orders', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 1)
+
     def test_get_order_not_found(self):
         """ Get a Order that doesn't exist """
         resp = self.app.get('/orders/0')
@@ -100,6 +163,41 @@ class TestOrderServer(unittest.TestCase):
         self.assertEqual(len(data), order_count + 1)
         self.assertIn(new_json, data)
 
+    def test_create_order_batch(self):
+        """ Create a batch of Orders """
+        order_count = self.get_order_count()
+        new_orders = [{'name': 'sammy', 'time': '04/14', 'status': True},
+                      {'name': 'tom', 'time': '04/15', 'status': False}]
+        resp = self.app.post('/orders/batch', data=json.dumps(new_orders),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_201_CREATED)
+        data = json.loads(resp.data)
+        self.assertEqual([item['order']['name'] for item in data], ['sammy', 'tom'])
+        resp = self.app.get(data[1]['location'])
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['name'], 'tom')
+        self.assertEqual(self.get_order_count(), order_count + 2)
+
+    def test_create_order_batch_ndjson(self):
+        """ Create a batch of Orders from NDJSON """
+        lines = '{"name": "sammy", "time": "04/14", "status": true}\n' \
+                '{"name": "tom", "time": "04/15", "status": true}\n'
+        resp = self.app.post('/orders/batch', data=lines, content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, HTTP_201_CREATED)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_create_order_batch_with_bad_item(self):
+        """ Create a batch of Orders where one has no name """
+        order_count = self.get_order_count()
+        new_orders = [{'name': 'sammy', 'time': '04/14', 'status': True},
+                      {'time': '04/15', 'status': True}]
+        resp = self.app.post('/orders/batch', data=json.dumps(new_orders),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        data = json.loads(resp.data)
+        self.assertEqual([error['index'] for error in data['errors']], [1])
+        self.assertEqual(self.get_order_count(), order_count)
+
     def test_update_order(self):
         """ Update a Order """
         new_order = {'name': 'kate', 'time': '12/21', 'status': True}
@@ -111,6 +209,21 @@ class TestOrderServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(new_json['time'], '12/21')
 
+    def test_patch_order(self):
+        """ Update some fields of a Order """
+        data = json.dumps({'time': '12/21'})
+        resp = self.app.patch('/orders/2', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        new_json = json.loads(resp.data)
+        self.assertEqual(new_json, {'id': 2, 'name': 'kate', 'time': '12/21', 'status': True})
+        resp = self.app.get('/orders', query_string='time=12/21')
+        self.assertEqual([order['id'] for order in json.loads(resp.data)], [2])
+        resp = self.app.patch('/orders/2', data=json.dumps({'status': 'no'}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.patch('/orders/0', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+
     def test_update_order_with_no_name(self):
         """ Update a Order without assigning a name """
         new_order = {'time': '11/11'}
@@ -173,6 +286,28 @@ class TestOrderServer(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item['time'], '09/15')
 
+    def test_query_order_list_by_time_range(self):
+        """ Query Orders by a range of times """
+        server.data_load({"name": "leo", "time": "2017-09-15T10:00", "status": True})
+        server.data_load({"name": "mia", "time": "2017-06-06", "status": True})
+        resp = self.app.get('/orders', query_string='time_from=2017-01-01')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([order['name'] for order in data], ['mia', 'leo'])
+        resp = self.app.get('/orders', query_string='time_to=2017-07-01&limit=1')
+        data = json.loads(resp.data)
+        self.assertEqual([order['name'] for order in data], ['mia'])
+        self.assertIsNone(resp.headers.get('Link'))
+        resp = self.app.get('/orders', query_string='time_from=2017-01-01&limit=1')
+        link = resp.headers.get('Link')
+        resp = self.app.get(link[link.index('<') + 1:link.index('>')])
+        data = json.loads(resp.data)
+        self.assertEqual([order['name'] for order in data], ['leo'])
+        resp = self.app.get('/orders', query_string='time_from=09/15')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders', query_string='time_from=2017-01-01&name=leo')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
     def test_query_order_list_by_name(self):
         """ Query Orders by name """
         resp = self.app.get('/orders', query_string='name=fred')
@@ -184,6 +319,89 @@ class TestOrderServer(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item['name'], 'fred')
 
+    def test_get_order_list_stream(self):
+        """ Stream the list of Orders as NDJSON """
+        resp = self.app.get('/orders', query_string='stream=1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        data = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(sorted(order['name'] for order in data), ['fred', 'kate'])
+        resp = self.app.get('/orders', query_string='name=kate',
+                            headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([order['name'] for order in data], ['kate'])
+
+    def test_get_order_list_by_page(self):
+        """ Page through the Orders with a cursor """
+        resp = self.app.get('/orders', query_string='limit=1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([order['name'] for order in data], ['fred'])
+        link = resp.headers.get('Link')
+        self.assertIn('rel="next"', link)
+        next_url = link[link.index('<') + 1:link.index('>')]
+        resp = self.app.get(next_url)
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([order['name'] for order in data], ['kate'])
+        self.assertIsNone(resp.headers.get('Link'))
+
+    def test_query_order_list_by_name_page(self):
+        """ Page through Orders queried by name """
+        resp = self.app.get('/orders', query_string='name=kate&limit=5')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['name'], 'kate')
+        self.assertIsNone(resp.headers.get('Link'))
+
+    def test_get_order_list_bad_cursor(self):
+        """ Page through the Orders with an invalid cursor """
+        resp = self.app.get('/orders', query_string='limit=1&cursor=bogus')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/orders', query_string='limit=0')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_server_timing(self):
+        """ Break a request down in a Server-Timing header """
+        with patch.dict(server.app.config, {'SERVER_TIMING': True}):
+            resp = self.app.get('/orders')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertIn('redis;dur=', resp.headers['Server-Timing'])
+        self.assertIn('encode;dur=', resp.headers['Server-Timing'])
+        self.assertIn('total;dur=', resp.headers['Server-Timing'])
+        resp = self.app.get('/orders')
+        self.assertNotIn('Server-Timing', resp.headers)
+
+    def test_metrics(self):
+        """ Expose request and Redis metrics """
+        self.app.get('/orders')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertIn('orders_http_request_duration_seconds_count{method="GET",route="/orders",status="200"}',
+                      resp.data)
+        self.assertIn('orders_redis_command_duration_seconds_count', resp.data)
+        self.assertIn('orders_list_results_count{query="all"}', resp.data)
+
+    def test_read_your_writes(self):
+        """ Read from the primary after a write when replicas lag """
+        self.addCleanup(server.init_db)
+        # an empty database stands in for a replica that has not caught up
+        with patch.dict(server.app.config, {'REDIS_REPLICAS': 'redis://127.0.0.1:6379/1'}):
+            server.init_db()
+            resp = self.app.get('/orders/1')
+            self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+            resp = self.app.get('/orders/1', headers={'X-Read-Your-Writes': 'true'})
+            self.assertEqual(resp.status_code, HTTP_200_OK)
+            new_order = {'name': 'sammy', 'time': '11/11', 'status': True}
+            resp = self.app.post('/orders', data=json.dumps(new_order),
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_201_CREATED)
+            self.assertIn(server.READ_YOUR_WRITES_COOKIE, resp.headers['Set-Cookie'])
+            resp = self.app.get(resp.headers['Location'])
+            self.assertEqual(resp.status_code, HTTP_200_OK)
+
     def test_purchase_a_order(self):
         """ Purchase a Order """
         resp = self.app.put('/orders/2/purchase', content_type='application/json')